@@ -0,0 +1,523 @@
+#!/bin/env python
+# Copyright 2020 Sunflower IT
+
+"""Benchmark and load test for the bouncer.
+
+Starts nginx-odoo.py against the stubs in bench/stubs.py, drives a mix
+of /auth, login + HOTP, /web/session/authenticate and logout traffic,
+and reports throughput, latency percentiles and memory use:
+
+    python bench/run.py --scenarios auth,mixed --duration 10 --json out.json
+
+Note that a .env in the repository overrides the settings made here.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import pyotp
+
+
+REPO_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), ".."))
+HOTP_SECRET = "BENCHBENCHBENCHBENCHBENCHBENCH23"
+PASSWORD = "bench"
+
+# Published in the README, checked with --check
+TARGET_AUTH_RPS = 2500
+TARGET_AUTH_P99_MS = 25
+
+SCENARIOS = {
+    "auth": {"auth": 1},
+    "login": {"login": 1},
+    "api": {"api": 1},
+    "logout": {"logout": 1},
+    # Roughly what NGINX sends during a busy morning
+    "mixed": {"auth": 90, "login": 4, "api": 4, "logout": 2},
+}
+
+COUNTER_RE = re.compile(r'name="counter" value="(\d+)"')
+CODE_RE = re.compile(r'name="code" value="(\w+)"')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def open_connection(address):
+    """Connect to a port on 127.0.0.1, or to the path of a Unix socket."""
+    if isinstance(address, str):
+        return await asyncio.open_unix_connection(address)
+    return await asyncio.open_connection("127.0.0.1", address)
+
+
+async def wait_for_port(address, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            reader, writer = await open_connection(address)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+def rss_kb(pid):
+    """Resident memory of a process and its children, in kB (Linux only)."""
+    total = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+            with open(f"/proc/{pid}/task/{pid}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            if not total:
+                return None
+    return total
+
+
+class Connection:
+    """Minimal HTTP/1.1 keep-alive client, cheap enough to not be the bottleneck."""
+
+    def __init__(self, address):
+        self.address = address
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, body=b"", headers=None):
+        if self.writer is None:
+            self.reader, self.writer = await open_connection(self.address)
+        lines = [f"{method} {path} HTTP/1.1", "Host: 127.0.0.1"]
+        for key, value in (headers or {}).items():
+            lines.append(f"{key}: {value}")
+        if body or method == "POST":
+            lines.append(f"Content-Length: {len(body)}")
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        try:
+            head = await self.reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.close()
+            raise
+        status_line, *header_lines = head.decode("latin-1").split("\r\n")
+        status = int(status_line.split(" ", 2)[1])
+        response_headers = {}
+        cookies = {}
+        for line in header_lines:
+            if not line:
+                continue
+            key, _, value = line.partition(":")
+            key = key.strip().lower()
+            value = value.strip()
+            if key == "set-cookie":
+                name, _, rest = value.partition("=")
+                cookies[name] = rest.split(";")[0]
+            response_headers[key] = value
+        if method == "HEAD" or status in (204, 304):
+            data = b""
+        elif response_headers.get("transfer-encoding") == "chunked":
+            data = await self.read_chunked()
+        else:
+            data = await self.reader.readexactly(
+                int(response_headers.get("content-length", 0))
+            )
+        if response_headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, cookies, data
+
+    async def read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self.reader.readline()).split(b";")[0], 16)
+            chunk = await self.reader.readexactly(size + 2)
+            if not size:
+                return b"".join(chunks)
+            chunks.append(chunk[:-2])
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class Bench:
+    def __init__(self, address, invalid_ratio):
+        self.address = address
+        self.invalid_ratio = invalid_ratio
+        self.hotp = pyotp.HOTP(HOTP_SECRET)
+        self.sessions = []
+
+    async def login(self, conn):
+        body = f"username=bench{random.randint(0, 999)}@example.com&password={PASSWORD}"
+        status, cookies, data = await conn.request(
+            "POST",
+            "/",
+            body.encode(),
+            {"Content-Type": "application/x-www-form-urlencoded"},
+        )
+        page = data.decode()
+        counter = COUNTER_RE.search(page)
+        code = CODE_RE.search(page)
+        if status != 200 or not counter or not code:
+            return False
+        counter = counter.group(1)
+        body = "counter={}&code={}&hotp_code={}".format(
+            counter, code.group(1), self.hotp.at(int(counter))
+        )
+        status, cookies, data = await conn.request(
+            "POST",
+            "/",
+            body.encode(),
+            {"Content-Type": "application/x-www-form-urlencoded"},
+        )
+        if status != 302 or "session_id" not in cookies:
+            return False
+        self.sessions.append(cookies["session_id"])
+        return True
+
+    async def api(self, conn):
+        params = {"db": "bench", "login": "bench@example.com", "password": PASSWORD}
+        status, cookies, data = await conn.request(
+            "POST",
+            "/web/session/authenticate",
+            json.dumps({"params": params}).encode(),
+            {"Content-Type": "application/json"},
+        )
+        if status != 200:
+            return False
+        result = json.loads(data)["result"]
+        params.update(
+            hotp_counter=result["hotp_counter"],
+            hotp_csrf=result["hotp_csrf"],
+            hotp_code=self.hotp.at(int(result["hotp_counter"])),
+        )
+        status, cookies, data = await conn.request(
+            "POST",
+            "/web/session/authenticate",
+            json.dumps({"params": params}).encode(),
+            {"Content-Type": "application/json"},
+        )
+        if status != 200:
+            return False
+        self.sessions.append(json.loads(data)["result"]["session_id"])
+        return True
+
+    async def auth(self, conn):
+        if self.sessions and random.random() >= self.invalid_ratio:
+            session = random.choice(self.sessions)
+            expected = 200
+        else:
+            session = "invalid" + str(random.randint(0, 1000000))
+            expected = 401
+        status, cookies, data = await conn.request(
+            "GET", "/auth", headers={"Cookie": f"session_id={session}"}
+        )
+        return status == expected
+
+    async def logout(self, conn):
+        if len(self.sessions) < 2:
+            # Unmeasured: a logout needs a session to end
+            return None
+        session = self.sessions.pop(random.randrange(len(self.sessions)))
+        status, cookies, data = await conn.request(
+            "GET", "/logout", headers={"Cookie": f"session_id={session}"}
+        )
+        return status == 302
+
+    async def run(self, mix, duration, concurrency, bouncer_pid):
+        ops = list(mix)
+        weights = [mix[op] for op in ops]
+        latencies = {op: [] for op in ops}
+        errors = {op: 0 for op in ops}
+        rss_peak = [rss_kb(bouncer_pid)]
+        deadline = time.monotonic() + duration
+
+        async def client():
+            conn = Connection(self.address)
+            while time.monotonic() < deadline:
+                op = random.choices(ops, weights)[0]
+                start = time.perf_counter()
+                try:
+                    ok = await getattr(self, op)(conn)
+                except (OSError, asyncio.IncompleteReadError, ValueError, KeyError):
+                    conn.close()
+                    ok = False
+                if ok is None:
+                    await self.login(conn)
+                    continue
+                latencies[op].append(time.perf_counter() - start)
+                if not ok:
+                    errors[op] += 1
+            conn.close()
+
+        async def sample_memory():
+            while time.monotonic() < deadline:
+                await asyncio.sleep(0.5)
+                rss_peak.append(rss_kb(bouncer_pid))
+
+        start = time.perf_counter()
+        await asyncio.gather(sample_memory(), *(client() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        result = {
+            "duration_s": round(elapsed, 3),
+            "concurrency": concurrency,
+            "throughput_rps": round(sum(map(len, latencies.values())) / elapsed, 1),
+            "rss_peak_kb": max((kb for kb in rss_peak if kb), default=None),
+            "rss_end_kb": rss_kb(bouncer_pid),
+            "ops": {},
+        }
+        for op in ops:
+            result["ops"][op] = summarize(latencies[op], errors[op], elapsed)
+        return result
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    def percentile(p):
+        if not count:
+            return None
+        return round(latencies[min(count - 1, int(count * p / 100))] * 1000, 3)
+
+    return {
+        "count": count,
+        "errors": errors,
+        "rps": round(count / elapsed, 1),
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+        "max_ms": percentile(100),
+    }
+
+
+def print_report(report, baseline=None):
+    print(f"{'scenario':10} {'op':8} {'count':>8} {'err':>5} {'rps':>9} "
+          f"{'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'rss kB':>9}")
+    for name, scenario in report["scenarios"].items():
+        for op, stats in scenario["ops"].items():
+            line = (
+                f"{name:10} {op:8} {stats['count']:8} {stats['errors']:5} "
+                f"{stats['rps']:9} {stats['p50_ms'] or '-':>8} "
+                f"{stats['p90_ms'] or '-':>8} {stats['p99_ms'] or '-':>8} "
+                f"{scenario['rss_peak_kb'] or '-':>9}"
+            )
+            old = (baseline or {}).get("scenarios", {}).get(name, {}).get("ops", {}).get(op)
+            if old and old["rps"] and old["p99_ms"] and stats["p99_ms"]:
+                line += "  ({:+.0%} rps, {:+.0%} p99)".format(
+                    stats["rps"] / old["rps"] - 1, stats["p99_ms"] / old["p99_ms"] - 1
+                )
+            print(line)
+    if "targets" in report:
+        targets = report["targets"]
+        print(
+            "/auth target {} rps, p99 < {} ms: {}".format(
+                targets["auth_rps"],
+                targets["auth_p99_ms"],
+                "passed" if targets["passed"] else "FAILED",
+            )
+        )
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_DIR,
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def benchmark(args):
+    odoo_port, smtp_port, port = free_port(), free_port(), free_port()
+    redis_port = free_port()
+    store = args.store
+    if store == "redis":
+        store = f"redis://127.0.0.1:{redis_port}"
+    home = tempfile.mkdtemp(prefix="bouncer-bench-")
+    # with --unix, the bouncer listens on a socket instead of the port
+    address = os.path.join(home, "bouncer.sock") if args.unix else port
+    env = dict(
+        os.environ,
+        HOME=home,
+        BOUNCER_ADMIN_USER_ODOO="admin",
+        BOUNCER_BACKGROUND_COLOR_ODOO="#8b6026",
+        BOUNCER_BRANDING_ODOO="Bench",
+        BOUNCER_BUTTON_COLOR_ODOO="#27AE60",
+        BOUNCER_BUTTON_HOVER_COLOR_ODOO="#30b166",
+        BOUNCER_BUTTON_SHADOW_COLOR_ODOO="#1e8449",
+        BOUNCER_DISABLE_EMAIL_ODOO="false" if args.email else "true",
+        BOUNCER_EXPIRY_INTERVAL_ODOO="+1 hours",
+        BOUNCER_HOTP_SECRET_ODOO=HOTP_SECRET,
+        BOUNCER_LISTEN_HOST_ODOO="127.0.0.1",
+        BOUNCER_LISTEN_PORT_ODOO="" if args.unix else str(port),
+        BOUNCER_LISTEN_SOCKET_ODOO=address if args.unix else "",
+        BOUNCER_ODOO_DATABASE_ODOO="bench",
+        BOUNCER_ODOO_URL_ODOO=f"http://127.0.0.1:{odoo_port}",
+        BOUNCER_SESSION_STORE_ODOO=store,
+        BOUNCER_SMTP_FROM_ODOO="bouncer@example.com",
+        BOUNCER_SMTP_PASS_ODOO="bench",
+        BOUNCER_SMTP_PORT_ODOO=str(smtp_port),
+        BOUNCER_SMTP_SERVER_ODOO="127.0.0.1",
+        BOUNCER_SMTP_SSL_ODOO="",
+        BOUNCER_SMTP_TO_ODOO="admin@example.com",
+        BOUNCER_SMTP_USER_ODOO="bench",
+        BOUNCER_WORKERS_ODOO=str(args.workers),
+    )
+    output = None if args.verbose else subprocess.DEVNULL
+    stubs = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(REPO_DIR, "bench", "stubs.py"),
+            "--odoo-port", str(odoo_port),
+            "--smtp-port", str(smtp_port),
+            "--password", PASSWORD,
+            "--odoo-delay", str(args.odoo_delay),
+        ]
+        + (["--redis-port", str(redis_port)] if args.store == "redis" else []),
+        stdout=output,
+        stderr=output,
+    )
+    bouncer = None
+    try:
+        await wait_for_port(odoo_port)
+        await wait_for_port(smtp_port)
+        if args.store == "redis":
+            await wait_for_port(redis_port)
+        bouncer = subprocess.Popen(
+            [sys.executable, os.path.join(REPO_DIR, "nginx-odoo.py")],
+            cwd=REPO_DIR,
+            env=env,
+            stdout=output,
+            stderr=output,
+        )
+        await wait_for_port(address)
+
+        bench = Bench(address, args.invalid_ratio)
+        conn = Connection(address)
+        for _ in range(args.sessions):
+            if not await bench.login(conn):
+                sys.exit("Could not log in to the bouncer, see --verbose")
+        conn.close()
+
+        report = {
+            "meta": {
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "workers": args.workers,
+                "store": args.store,
+                "unix": args.unix,
+                "concurrency": args.concurrency,
+                "duration_s": args.duration,
+                "odoo_delay_s": args.odoo_delay,
+                "email": args.email,
+                "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            },
+            "scenarios": {},
+        }
+        for name in args.scenarios:
+            report["scenarios"][name] = await bench.run(
+                SCENARIOS[name], args.duration, args.concurrency, bouncer.pid
+            )
+        auth = report["scenarios"].get("auth", {}).get("ops", {}).get("auth")
+        if auth:
+            report["targets"] = {
+                "auth_rps": TARGET_AUTH_RPS,
+                "auth_p99_ms": TARGET_AUTH_P99_MS,
+                "passed": auth["rps"] >= TARGET_AUTH_RPS
+                and auth["p99_ms"] is not None
+                and auth["p99_ms"] <= TARGET_AUTH_P99_MS
+                and not auth["errors"],
+            }
+        return report
+    finally:
+        for process in (bouncer, stubs):
+            if process:
+                process.terminate()
+                process.wait()
+        # The bouncer and its workers are gone, with their database
+        shutil.rmtree(home, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--scenarios",
+        default="auth,login,api,logout,mixed",
+        help="comma separated, from: " + ", ".join(SCENARIOS),
+    )
+    parser.add_argument("--duration", type=float, default=10, help="seconds per scenario")
+    parser.add_argument("--concurrency", type=int, default=20, help="parallel clients")
+    parser.add_argument("--workers", type=int, default=1, help="bouncer worker processes")
+    parser.add_argument(
+        "--store",
+        default="sqlite",
+        choices=("sqlite", "memory", "redis"),
+        help="session store, redis uses the stub in bench/stubs.py",
+    )
+    parser.add_argument(
+        "--unix", action="store_true", help="connect over a Unix socket instead of TCP"
+    )
+    parser.add_argument("--sessions", type=int, default=50, help="sessions to log in first")
+    parser.add_argument(
+        "--invalid-ratio", type=float, default=0.1, help="share of /auth with a bad cookie"
+    )
+    parser.add_argument(
+        "--odoo-delay", type=float, default=0.0, help="seconds per Odoo authenticate"
+    )
+    parser.add_argument(
+        "--no-email", dest="email", action="store_false", help="skip the SMTP stub"
+    )
+    parser.add_argument("--json", help="write the report as JSON to this file, - for stdout")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare with")
+    parser.add_argument(
+        "--check", action="store_true", help="exit with 1 when the /auth target is missed"
+    )
+    parser.add_argument("--verbose", action="store_true", help="show output of the servers")
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error("unknown scenarios: " + ", ".join(sorted(unknown)))
+
+    report = asyncio.run(benchmark(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report, baseline)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+    if args.check and not report.get("targets", {}).get("passed"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
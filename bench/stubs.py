@@ -0,0 +1,336 @@
+#!/bin/env python
+# Copyright 2020 Sunflower IT
+
+"""Stand-ins for Odoo, an SMTP server and a Redis server, for benchmarks.
+
+Run standalone to try the bouncer without a real Odoo:
+
+    python bench/stubs.py --odoo-port 8069 --smtp-port 2525 --redis-port 6379
+"""
+
+import argparse
+import asyncio
+import json
+import secrets
+import time
+
+import tornado.ioloop
+import tornado.web
+
+
+class OdooAuthenticateHandler(tornado.web.RequestHandler):
+    async def post(self):
+        params = json.loads(self.request.body)["params"]
+        if self.settings["odoo_delay"]:
+            # Odoo spends most of a login hashing the password
+            await asyncio.sleep(self.settings["odoo_delay"])
+        if params.get("password") != self.settings["password"]:
+            return self.write(
+                {"jsonrpc": "2.0", "error": {"message": "Access Denied"}}
+            )
+        session_id = secrets.token_hex(20)
+        self.set_cookie("session_id", session_id)
+        self.write(
+            {
+                "jsonrpc": "2.0",
+                "result": {
+                    "uid": 2,
+                    "username": params.get("login"),
+                    "db": params.get("db"),
+                    "session_id": session_id,
+                },
+            }
+        )
+
+
+class OdooJsonRpcHandler(tornado.web.RequestHandler):
+    def post(self):
+        self.write({"jsonrpc": "2.0", "result": {"server_version": "stub"}})
+
+
+class OdooPunchoutHandler(tornado.web.RequestHandler):
+    def get(self):
+        if not (self.get_argument("token", None) or self.get_argument("signup_token", None)):
+            return self.set_status(403)
+        self.set_cookie("session_id", secrets.token_hex(20))
+        self.write(b"<html>" + b"x" * self.settings["punchout_size"] + b"</html>")
+
+    post = get
+
+
+def odoo_app(password="bench", odoo_delay=0.0, punchout_size=50000):
+    return tornado.web.Application(
+        [
+            (r"/web/session/authenticate", OdooAuthenticateHandler),
+            (r"/jsonrpc", OdooJsonRpcHandler),
+            (r"/punchouttokenlogin", OdooPunchoutHandler),
+            (r"/punchout/signup", OdooPunchoutHandler),
+        ],
+        password=password,
+        odoo_delay=odoo_delay,
+        punchout_size=punchout_size,
+    )
+
+
+class SMTPStub:
+    """Accepts any login and swallows all mail."""
+
+    def __init__(self):
+        self.connections = 0
+        self.messages = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        writer.write(b"220 stub ESMTP\r\n")
+        in_data = False
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if in_data:
+                if line == b".\r\n":
+                    in_data = False
+                    self.messages += 1
+                    writer.write(b"250 queued\r\n")
+                continue
+            command = line[:4].upper()
+            if command in (b"EHLO", b"HELO"):
+                writer.write(b"250-stub\r\n250 AUTH PLAIN LOGIN\r\n")
+            elif command == b"AUTH":
+                writer.write(b"235 authenticated\r\n")
+            elif command == b"DATA":
+                in_data = True
+                writer.write(b"354 go ahead\r\n")
+            elif command == b"QUIT":
+                writer.write(b"221 bye\r\n")
+                await writer.drain()
+                break
+            else:
+                writer.write(b"250 ok\r\n")
+            await writer.drain()
+        writer.close()
+
+    async def start(self, host, port):
+        return await asyncio.start_server(self.handle, host, port)
+
+
+class RedisStub:
+    """Keeps the keys and streams the bouncer uses, in memory.
+
+    Speaks just enough of the Redis protocol for lib/redisstore.py:
+    strings with an expiry, counters, transactions, streams and sorted
+    sets.
+    """
+
+    def __init__(self):
+        self.values = {}
+        # key -> expiry in seconds since the epoch
+        self.expiries = {}
+        # key -> list of (id, fields)
+        self.streams = {}
+        # key -> {member: score}
+        self.sorted_sets = {}
+        self.last_stream_id = (0, 0)
+
+    def get(self, key):
+        expiry = self.expiries.get(key)
+        if expiry is not None and expiry <= time.time():
+            del self.values[key], self.expiries[key]
+        return self.values.get(key)
+
+    def set(self, key, value, expiry=None):
+        self.values[key] = value
+        self.expiries.pop(key, None)
+        if expiry is not None:
+            self.expiries[key] = expiry
+
+    def next_stream_id(self):
+        now = int(time.time() * 1000)
+        if now > self.last_stream_id[0]:
+            self.last_stream_id = (now, 0)
+        else:
+            self.last_stream_id = (self.last_stream_id[0], self.last_stream_id[1] + 1)
+        return "%d-%d" % self.last_stream_id
+
+    @staticmethod
+    def stream_id(text):
+        ms, _sep, seq = text.partition("-")
+        return int(ms), int(seq or 0)
+
+    def call(self, name, *args):
+        """Run a command, return its reply; raise ValueError for an error."""
+
+        if name == "PING":
+            return "PONG"
+        if name in ("AUTH", "SELECT"):
+            return "OK"
+        if name == "GET":
+            return self.get(args[0])
+        if name == "SET":
+            options = [arg.upper() for arg in args[2:]]
+            if "XX" in options and self.get(args[0]) is None:
+                return None
+            expiry = None
+            if "EX" in options:
+                expiry = time.time() + int(args[2 + options.index("EX") + 1])
+            self.set(args[0], args[1], expiry)
+            return "OK"
+        if name == "DEL":
+            deleted = 0
+            for key in args:
+                if self.get(key) is not None:
+                    deleted += 1
+                self.values.pop(key, None)
+                self.expiries.pop(key, None)
+            return deleted
+        if name == "EXPIREAT":
+            if self.get(args[0]) is None:
+                return 0
+            self.expiries[args[0]] = int(args[1])
+            return 1
+        if name in ("INCR", "INCRBY"):
+            value = int(self.get(args[0]) or 0) + (int(args[1]) if args[1:] else 1)
+            self.values[args[0]] = str(value)
+            return value
+        if name == "XADD":
+            key, args = args[0], list(args[1:])
+            maxlen = None
+            if args[0].upper() == "MAXLEN":
+                if args[1] in ("~", "="):
+                    del args[1]
+                maxlen, args = int(args[1]), args[2:]
+            fields = args[1:]
+            stream = self.streams.setdefault(key, [])
+            stream.append((self.next_stream_id(), fields))
+            if maxlen is not None:
+                del stream[:-maxlen]
+            return stream[-1][0]
+        if name == "XREVRANGE":
+            count = int(args[4]) if len(args) > 4 else None
+            entries = [list(entry) for entry in reversed(self.streams.get(args[0], []))]
+            return entries[:count]
+        if name == "XREAD":
+            args = list(args)
+            count = None
+            if args[0].upper() == "COUNT":
+                count, args = int(args[1]), args[2:]
+            key, last_id = args[1], self.stream_id(args[2])
+            entries = [
+                list(entry)
+                for entry in self.streams.get(key, [])
+                if self.stream_id(entry[0]) > last_id
+            ][:count]
+            return [[key, entries]] if entries else None
+        if name == "ZADD":
+            members = self.sorted_sets.setdefault(args[0], {})
+            added = 0
+            for score, member in zip(args[1::2], args[2::2]):
+                added += member not in members
+                members[member] = float(score)
+            return added
+        if name in ("ZRANGEBYSCORE", "ZREMRANGEBYSCORE"):
+            members = self.sorted_sets.get(args[0], {})
+            low, high = float(args[1]), float(args[2])
+            found = sorted(
+                (score, member)
+                for member, score in members.items()
+                if low <= score <= high
+            )
+            if name == "ZREMRANGEBYSCORE":
+                for score, member in found:
+                    del members[member]
+                return len(found)
+            reply = []
+            for score, member in found:
+                reply.append(member)
+                if "WITHSCORES" in (arg.upper() for arg in args[3:]):
+                    reply.append("%d" % score)
+            return reply
+        raise ValueError("ERR unknown command '{}'".format(name))
+
+    @classmethod
+    def encode(cls, reply):
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, int):
+            return b":%d\r\n" % reply
+        if isinstance(reply, list):
+            return b"*%d\r\n" % len(reply) + b"".join(cls.encode(item) for item in reply)
+        data = reply.encode()
+        return b"$%d\r\n%s\r\n" % (len(data), data)
+
+    async def handle(self, reader, writer):
+        queued = None
+        while True:
+            try:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = []
+                for _ in range(int(line[1:])):
+                    length = int((await reader.readline())[1:])
+                    command.append((await reader.readexactly(length + 2))[:-2].decode())
+            except (ValueError, asyncio.IncompleteReadError):
+                break
+            name, args = command[0].upper(), command[1:]
+            if name == "MULTI":
+                queued = []
+                writer.write(b"+OK\r\n")
+            elif name == "EXEC":
+                replies = []
+                for queued_name, queued_args in queued or []:
+                    try:
+                        replies.append(self.call(queued_name, *queued_args))
+                    except ValueError as e:
+                        replies.append(e)
+                queued = None
+                writer.write(b"*%d\r\n" % len(replies))
+                for reply in replies:
+                    if isinstance(reply, ValueError):
+                        writer.write(b"-%s\r\n" % str(reply).encode())
+                    else:
+                        writer.write(self.encode(reply))
+            elif queued is not None:
+                queued.append((name, args))
+                writer.write(b"+QUEUED\r\n")
+            else:
+                try:
+                    writer.write(self.encode(self.call(name, *args)))
+                except ValueError as e:
+                    writer.write(b"-%s\r\n" % str(e).encode())
+            await writer.drain()
+        writer.close()
+
+    async def start(self, host, port):
+        return await asyncio.start_server(self.handle, host, port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--odoo-port", type=int, default=8069)
+    parser.add_argument("--smtp-port", type=int, default=2525)
+    parser.add_argument("--redis-port", type=int, help="also start the Redis stub")
+    parser.add_argument("--password", default="bench")
+    parser.add_argument(
+        "--odoo-delay", type=float, default=0.0, help="seconds per authenticate"
+    )
+    parser.add_argument(
+        "--punchout-size", type=int, default=50000, help="bytes per punchout page"
+    )
+    args = parser.parse_args()
+
+    io_loop = tornado.ioloop.IOLoop.current()
+    odoo_app(args.password, args.odoo_delay, args.punchout_size).listen(
+        args.odoo_port, args.host
+    )
+    io_loop.run_sync(lambda: SMTPStub().start(args.host, args.smtp_port))
+    if args.redis_port:
+        io_loop.run_sync(lambda: RedisStub().start(args.host, args.redis_port))
+        print(f"Redis stub at {args.redis_port}", flush=True)
+    print(f"Odoo stub at {args.odoo_port}, SMTP stub at {args.smtp_port}", flush=True)
+    io_loop.start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+#!/bin/env python
+
+"""Write gzip and, when the brotli package is installed, brotli variants of
+the static files. The bouncer serves them instead of the originals."""
+
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+# Already compressed, or variants written before
+SKIPPED = (".br", ".gz", ".jpg", ".png")
+
+compressors = [(".gz", lambda data: gzip.compress(data, compresslevel=9))]
+if brotli:
+    compressors.append((".br", lambda data: brotli.compress(data)))
+else:
+    print("Install the brotli package to also write brotli variants")
+
+for name in sorted(os.listdir(STATIC_PATH)):
+    path = os.path.join(STATIC_PATH, name)
+    if name.endswith(SKIPPED) or not os.path.isfile(path):
+        continue
+    with open(path, "rb") as f:
+        data = f.read()
+    for suffix, compress in compressors:
+        compressed = compress(data)
+        if len(compressed) >= len(data):
+            continue
+        with open(path + suffix, "wb") as f:
+            f.write(compressed)
+        print("{}: {} -> {} bytes".format(name + suffix, len(data), len(compressed)))
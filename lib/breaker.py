@@ -0,0 +1,72 @@
+#!/bin/env python
+# Copyright 2020 Sunflower IT
+
+import collections
+import logging
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """Stops calls to an upstream that keeps failing.
+
+    Tracks the outcome of the last `calls` calls. When at least `rate` of
+    them failed, the circuit opens and calls fail right away instead of
+    waiting for a timeout. After `reset_timeout` seconds, one call is let
+    through as a probe: when it succeeds, the circuit closes again.
+    """
+
+    def __init__(self, name, rate=0.5, calls=10, reset_timeout=30):
+        self.name = name
+        self.rate = rate
+        self.reset_timeout = reset_timeout
+        self.outcomes = collections.deque(maxlen=calls)
+        self.state = CLOSED
+        self.opened_at = 0
+        self.probing = False
+
+    def allow(self):
+        """Whether a call may be made now."""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = HALF_OPEN
+        if self.probing:
+            return False
+        self.probing = True
+        return True
+
+    def succeeded(self):
+        self.probing = False
+        if self.state != CLOSED:
+            logging.warning("%s is back, closing the circuit", self.name)
+            self.state = CLOSED
+            self.outcomes.clear()
+        self.outcomes.append(True)
+
+    def failed(self):
+        self.probing = False
+        if self.state == HALF_OPEN:
+            return self.open()
+        self.outcomes.append(False)
+        if (
+            self.state == CLOSED
+            and len(self.outcomes) == self.outcomes.maxlen
+            and self.outcomes.count(False) >= self.rate * len(self.outcomes)
+        ):
+            self.open()
+
+    def open(self):
+        if self.state == CLOSED:
+            logging.warning(
+                "%s is failing, rejecting calls for %s seconds",
+                self.name,
+                self.reset_timeout,
+            )
+        self.state = OPEN
+        self.opened_at = time.monotonic()
@@ -0,0 +1,106 @@
+#!/bin/env python
+# Copyright 2020 Sunflower IT
+
+import hmac
+import random
+import string
+import time
+
+
+# Same lifetime as the rows of hotp_codes
+CHALLENGE_TTL = 15 * 60
+# HOTP counters reserved in the database at a time
+COUNTER_BLOCK_SIZE = 100
+# Wrong security codes after which a challenge is dropped, and the user
+# has to log in again for a new code
+MAX_CODE_FAILURES = 5
+
+
+def random_code():
+    """A random code to be provided by the form."""
+    return "".join(
+        random.SystemRandom().choice(string.ascii_uppercase + string.digits)
+        for _ in range(16)
+    )
+
+
+class MemoryChallenges:
+    """Keeps pending security codes in memory instead of in hotp_codes.
+
+    A drop-in for the HOTP methods of DB, without a disk write per login.
+    Counters are still reserved from the database, a block at a time, so
+    HOTP values never repeat after a restart. Pending codes are lost on a
+    restart, and are only known to the process that issued them.
+    """
+
+    def __init__(self, db, ttl=CHALLENGE_TTL, block_size=COUNTER_BLOCK_SIZE):
+        self.db = db
+        self.ttl = ttl
+        self.block_size = block_size
+        # counter -> (code, session_id, expiry, payload, username)
+        self.pending = {}
+        # counter -> wrong codes given for it
+        self.failures = {}
+        self.next_counter = 0
+        self.last_counter = -1
+
+    async def next_hotp_id(self, session_id, payload=None, username=None):
+        if self.next_counter > self.last_counter:
+            self.next_counter = await self.db.reserve_hotp_ids(self.block_size)
+            self.last_counter = self.next_counter + self.block_size - 1
+        counter = self.next_counter
+        self.next_counter += 1
+        code = random_code()
+        self.pending[counter] = (
+            code,
+            session_id,
+            time.time() + self.ttl,
+            payload,
+            username,
+        )
+        return counter, code
+
+    async def verify_code_and_expiry(self, counter, code):
+        try:
+            counter = int(counter)
+        except (TypeError, ValueError):
+            return False, None, None
+        challenge = self.pending.get(counter)
+        if (
+            challenge is None
+            or challenge[2] <= time.time()
+            or not hmac.compare_digest(challenge[0], str(code))
+        ):
+            return False, None, None
+        del self.pending[counter]
+        self.failures.pop(counter, None)
+        return challenge[1], challenge[3], challenge[4]
+
+    async def fail_code(self, counter, code):
+        try:
+            counter = int(counter)
+        except (TypeError, ValueError):
+            return None
+        challenge = self.pending.get(counter)
+        if challenge is None or not hmac.compare_digest(challenge[0], str(code)):
+            return None
+        failures = self.failures.get(counter, 0) + 1
+        if failures >= MAX_CODE_FAILURES:
+            del self.pending[counter]
+            self.failures.pop(counter, None)
+        else:
+            self.failures[counter] = failures
+        return challenge[4]
+
+    async def prune(self):
+        now = time.time()
+        self.pending = {
+            counter: challenge
+            for counter, challenge in self.pending.items()
+            if challenge[2] > now
+        }
+        self.failures = {
+            counter: failures
+            for counter, failures in self.failures.items()
+            if counter in self.pending
+        }
@@ -1,17 +1,29 @@
+import base64
+import hashlib
+import hmac
 import os
+import re
 import sys
 import logging
 from pathlib import Path
 
+from lib import logs
+from lib.challenges import MemoryChallenges
 from lib.db import DB
+from lib.email import Email
 from lib.odooauth import OdooAuthHandler
+from lib.outbox import Outbox
+from lib.redisstore import RedisStore
+from lib.sessionstore import MemoryStore
+from lib.tenants import Tenant, Tenants
+from lib.tokens import TokenSigner
 
 assert sys.version_info.major == 3, "Requires Python 3."
 
 
 import os
 import sys
-from dotenv import load_dotenv
+from dotenv import dotenv_values, load_dotenv
 
 
 SCRIPT_PATH = os.path.abspath(os.path.dirname(__file__))
@@ -40,94 +52,334 @@ BOUNCER_SMTP_TO_ODOO = os.environ["BOUNCER_SMTP_TO_ODOO"]
 BOUNCER_SMTP_USER_ODOO = os.environ["BOUNCER_SMTP_USER_ODOO"]
 
 
-logging.basicConfig(level=logging.INFO)
+# Logging
+# level of all loggers, then per logger, like 'httpx=WARNING,tornado.access=ERROR'
+LOG_LEVEL = os.environ.get("BOUNCER_LOG_LEVEL_ODOO", "INFO")
+LOG_LEVELS = logs.parse_levels(os.environ.get("BOUNCER_LOG_LEVELS_ODOO", ""))
+logs.setup(LOG_LEVEL, LOG_LEVELS)
+# share of /auth requests that is logged, by the bouncer.auth logger
+AUTH_LOG_RATE = float(os.environ.get("BOUNCER_AUTH_LOG_RATE_ODOO", 0))
 
 _logger = logging.getLogger(__name__)
 
-# load and check HOTP secret
-HOTP_SECRET = os.environ.get("BOUNCER_HOTP_SECRET_ODOO")
-hotp_secret_length = len(HOTP_SECRET) if HOTP_SECRET else 0
-if hotp_secret_length != 32:
-    sys.exit(
-        "HOTP secret in .env must be 32 characters, has {}".format(hotp_secret_length)
-    )
-
 # load and check listen settings
 # (when running as a developer, from command line instead of with uwsgi)
-LISTEN_PORT = os.environ.get("BOUNCER_LISTEN_PORT_ODOO", 8888)
+LISTEN_PORT = int(os.environ.get("BOUNCER_LISTEN_PORT_ODOO", 8888) or 0)
 LISTEN_HOST = os.environ.get("BOUNCER_LISTEN_HOST_ODOO", "localhost")
+# Unix domain socket to listen on, instead of or next to the TCP port,
+# and its permissions; NGINX must be able to write to it
+LISTEN_SOCKET = os.environ.get("BOUNCER_LISTEN_SOCKET_ODOO")
+LISTEN_SOCKET_MODE = int(os.environ.get("BOUNCER_LISTEN_SOCKET_MODE_ODOO", "660"), 8)
+if not LISTEN_PORT and not LISTEN_SOCKET:
+    sys.exit("Set BOUNCER_LISTEN_PORT_ODOO or BOUNCER_LISTEN_SOCKET_ODOO")
+# Keep connections from NGINX open for more requests, and close them when
+# idle for this many seconds; longer than keepalive_timeout of NGINX
+KEEPALIVE = os.environ.get("BOUNCER_KEEPALIVE_ODOO", "true").lower() == "true"
+IDLE_TIMEOUT = float(os.environ.get("BOUNCER_IDLE_TIMEOUT_ODOO", 3600))
+
+# Number of worker processes, 0 means one per CPU core
+WORKERS = int(os.environ.get("BOUNCER_WORKERS_ODOO", 1))
+# Seconds between picking up session changes made by other workers
+SYNC_INTERVAL = float(os.environ.get("BOUNCER_SYNC_INTERVAL_ODOO", 1))
+
+# Prometheus metrics at /metrics on a separate port, that NGINX
+# must not proxy to; disabled when empty
+METRICS_PORT = int(os.environ.get("BOUNCER_METRICS_PORT_ODOO") or 0)
+METRICS_HOST = os.environ.get("BOUNCER_METRICS_HOST_ODOO", "localhost")
+
+# Brute force protection: failed logins allowed per client IP and per
+# username within the window (in seconds), 0 to disable
+LOGIN_IP_LIMIT = int(os.environ.get("BOUNCER_LOGIN_IP_LIMIT_ODOO", 30))
+LOGIN_USER_LIMIT = int(os.environ.get("BOUNCER_LOGIN_USER_LIMIT_ODOO", 10))
+LOGIN_WINDOW = float(os.environ.get("BOUNCER_LOGIN_WINDOW_ODOO", 900))
+# Take the client IP from the X-Real-Ip or X-Forwarded-For header set by
+# NGINX; only enable this when clients cannot reach the bouncer directly
+XHEADERS = os.environ.get("BOUNCER_XHEADERS_ODOO", "false").lower() == "true"
+# Seconds between summaries of failed logins and session checks
+FAILURE_LOG_INTERVAL = float(os.environ.get("BOUNCER_FAILURE_LOG_INTERVAL_ODOO", 60))
 
 # other settings
-EXPIRY_INTERVAL = os.environ.get("BOUNCER_EXPIRY_INTERVAL_ODOO", "+16 hours")
-
-
-# Email
-# load and check email settings
-SMTP_SERVER = os.environ.get("BOUNCER_SMTP_SERVER_ODOO")
-SMTP_SSL = os.environ.get("BOUNCER_SMTP_SSL_ODOO")
-SMTP_PORT = os.environ.get("BOUNCER_SMTP_PORT_ODOO", 465 if SMTP_SSL else 25)
-SMTP_FROM = os.environ.get("BOUNCER_SMTP_FROM_ODOO")
-ADMIN_USER = os.environ.get("BOUNCER_ADMIN_USER_ODOO", "admin")
-SMTP_TO = os.environ.get("BOUNCER_SMTP_TO_ODOO")
-SMTP_USER = os.environ.get("BOUNCER_SMTP_USER_ODOO")
-SMTP_PASS = os.environ.get("BOUNCER_SMTP_PASS_ODOO")
-
-# Database
-# open database
-user_home_dir = os.path.expanduser("~")
-user_config_dir = os.path.expanduser("~") + "/.config/nginx-odoo"
-Path(user_config_dir).mkdir(parents=True, exist_ok=True)
-db_path = user_config_dir + "/database.db"
-db = DB(db_path)
-os.chmod(db_path, 0o600)
-db_perm = os.stat(db_path).st_mode & 0o777
-if db_perm != 0o600:
-    sys.exit(
-        "File permissions of {} must be 600 but are: {:o}".format(db_path, db_perm)
-    )
-db.cleanup()
-
-
-# Odoo
-# check Odoo settings
-ODOO_URL = os.environ.get("BOUNCER_ODOO_URL_ODOO", "http://localhost:8069")
-if ODOO_URL.endswith("/"):
-    ODOO_URL = ODOO_URL[:-1]
-ODOO_DATABASE = os.environ.get("BOUNCER_ODOO_DATABASE_ODOO")
-if not ODOO_DATABASE:
-    sys.exit("Odoo settings not set in .env")
-
-# try to connect to odoo
-try:
-    odoo = OdooAuthHandler()
-    odoo.test(ODOO_URL)
-except Exception:
-    _logger.warning("Odoo not running at {}".format(ODOO_URL))
-
-auth_params = {
-    "url": ODOO_URL + "/web/session/authenticate",
-    "url_punchout_login": ODOO_URL + "/punchouttokenlogin",
-    "url_punchout_signup": ODOO_URL + "/punchout/signup",
-    "database": ODOO_DATABASE,
-}
-OdooAuthHandler.set_params(auth_params)
-
-
-# Branding
-# load and check branding settings
-BRANDING = os.environ.get("BOUNCER_BRANDING_ODOO", "")
-BACKGROUNDCOLOR = os.environ.get("BOUNCER_BACKGROUND_COLOR_ODOO", "")
-BUTTONCOLOR = os.environ.get("BOUNCER_BUTTON_COLOR_ODOO", "")
-BUTTONHOVERCOLOR = os.environ.get("BOUNCER_BUTTON_HOVER_COLOR_ODOO", "")
-BUTTONSHADOWCOLOR = os.environ.get("BOUNCER_BUTTON_SHADOW_COLOR_ODOO", "")
-
-theme_params = {
-    "backgroundcolor": BACKGROUNDCOLOR,
-    "buttoncolor": BUTTONCOLOR,
-    "buttonshadowcolor": BUTTONSHADOWCOLOR,
-    "buttonhovercolor": BUTTONHOVERCOLOR,
-    "branding": BRANDING,
-}
+# Seconds between removing expired sessions and security codes
+CLEANUP_INTERVAL = float(os.environ.get("BOUNCER_CLEANUP_INTERVAL_ODOO", 60))
+# Seconds between checks whether Odoo is up
+ODOO_HEALTH_INTERVAL = float(os.environ.get("BOUNCER_ODOO_HEALTH_INTERVAL_ODOO", 10))
+# Seconds that idle SMTP connections are kept open for reuse
+SMTP_POOL_IDLE = float(os.environ.get("BOUNCER_SMTP_POOL_IDLE_ODOO", 60))
+# send security codes from a queue in the background, instead of while
+# the user waits for the page with the code field
+EMAIL_OUTBOX = os.environ.get("BOUNCER_EMAIL_OUTBOX_ODOO", "false").lower() == "true"
+
+# Tracing
+# share of requests, other than /auth, whose time in Odoo, SMTP, the
+# session store and templates is measured, 0 to disable
+TRACE_RATE = float(os.environ.get("BOUNCER_TRACE_RATE_ODOO", 0))
+# send these timings in a Server-Timing header, and log them with the
+# bouncer.trace logger
+TRACE_HEADER = os.environ.get("BOUNCER_TRACE_HEADER_ODOO", "true").lower() == "true"
+TRACE_LOG = os.environ.get("BOUNCER_TRACE_LOG_ODOO", "false").lower() == "true"
+# /debug/profile and /debug/allocations on the metrics port
+PROFILER = os.environ.get("BOUNCER_PROFILER_ODOO", "false").lower() == "true"
+
+# Caching of /auth answers by NGINX
+# longest time in seconds a valid answer may be cached, 0 to not cache
+AUTH_CACHE_MAX = int(os.environ.get("BOUNCER_AUTH_CACHE_MAX_ODOO", 0))
+# location that purges cached answers for the cookies of a logout
+AUTH_CACHE_PURGE_URL = os.environ.get("BOUNCER_AUTH_CACHE_PURGE_URL_ODOO")
+
+# let /auth check a signed token instead of looking up the session
+SIGNED_TOKENS = os.environ.get("BOUNCER_SIGNED_TOKENS_ODOO", "false").lower() == "true"
+
+# Other Odoo instances served by this bouncer: a directory with a
+# <name>.env file for each, with settings that differ from .env
+TENANTS_DIR = os.environ.get("BOUNCER_TENANTS_DIR_ODOO")
 
 # Debug
-disable_email = os.environ.get("BOUNCER_DISABLE_EMAIL_ODOO", "false").lower() == "true"
+# recompile templates on every request, and restart when code changes
+DEBUG = os.environ.get("BOUNCER_DEBUG_ODOO", "false").lower() == "true"
+
+
+def config_file(filename):
+    """Path of a file in the config directory, only readable by its owner."""
+
+    user_config_dir = os.path.expanduser("~") + "/.config/nginx-odoo"
+    Path(user_config_dir).mkdir(parents=True, exist_ok=True)
+    path = user_config_dir + "/" + filename
+    # SQLite gives the -wal and -shm files the permissions of the database
+    Path(path).touch(mode=0o600)
+    os.chmod(path, 0o600)
+    return path
+
+
+def check_permissions(path):
+    os.chmod(path, 0o600)
+    perm = os.stat(path).st_mode & 0o777
+    if perm != 0o600:
+        sys.exit("File permissions of {} must be 600 but are: {:o}".format(path, perm))
+
+
+def open_store(name, env):
+    """The session store of a tenant, as set in its environment."""
+
+    # 'sqlite' keeps sessions in a file, 'memory' in this process only (for
+    # tests and benchmarks), and a redis:// URL shares them between hosts
+    session_store = env.get("BOUNCER_SESSION_STORE_ODOO", "sqlite")
+    if session_store == "sqlite":
+        # open database
+        if name == "default":
+            db_path = config_file("database.db")
+        else:
+            db_path = config_file("database-{}.db".format(name))
+        db = DB(db_path)
+        check_permissions(db_path)
+    elif session_store == "memory":
+        if WORKERS != 1:
+            sys.exit("BOUNCER_SESSION_STORE_ODOO=memory requires a single worker")
+        db = MemoryStore()
+    elif session_store.startswith(("redis://", "rediss://")):
+        # keys start with this, so several bouncers can share one server
+        db = RedisStore(
+            session_store,
+            env["BOUNCER_SESSION_PREFIX_ODOO"],
+            float(env.get("BOUNCER_REDIS_TIMEOUT_ODOO", 5)),
+        )
+    else:
+        sys.exit("Unknown BOUNCER_SESSION_STORE_ODOO: {}".format(session_store))
+    # Seconds to gather session changes before writing them in one
+    # transaction, and the most changes written at once
+    db.write_delay = float(env.get("BOUNCER_WRITE_DELAY_ODOO", 0))
+    db.write_batch_size = int(env.get("BOUNCER_WRITE_BATCH_SIZE_ODOO", 100))
+    # other workers must find a session before the browser comes back with it
+    db.wait_for_writes = WORKERS != 1 or db.lookup_on_miss
+    return db
+
+
+def tenant_secret(secret, name):
+    """A secret of a tenant's own, derived from one in .env, in base32."""
+    digest = hmac.new(secret.encode(), name.encode(), hashlib.sha256).digest()
+    return base64.b32encode(digest[:20]).decode()
+
+
+def load_tenant(name, env):
+    """Read the settings of a tenant, and open its connections and store."""
+
+    # load and check HOTP secret
+    hotp_secret = env.get("BOUNCER_HOTP_SECRET_ODOO")
+    hotp_secret_length = len(hotp_secret) if hotp_secret else 0
+    if hotp_secret_length != 32:
+        sys.exit(
+            "HOTP secret of {} must be 32 characters, has {}".format(
+                name, hotp_secret_length
+            )
+        )
+
+    # Host headers of the requests for this tenant, comma separated
+    hosts = [
+        host.strip()
+        for host in env.get("BOUNCER_HOSTS_ODOO", "").split(",")
+        if host.strip()
+    ]
+    expiry_interval = env.get("BOUNCER_EXPIRY_INTERVAL_ODOO", "+16 hours")
+    db = open_store(name, env)
+    session_lifetime = db.interval_seconds(expiry_interval)
+    # A session expires the expiry interval after its last use instead of
+    # after the login. Its new expiry is written every touch interval (in
+    # seconds) at most, not on every session check.
+    if env.get("BOUNCER_SLIDING_EXPIRY_ODOO", "false").lower() == "true":
+        if SIGNED_TOKENS:
+            sys.exit("BOUNCER_SLIDING_EXPIRY_ODOO does not work with signed tokens")
+        db.sliding_lifetime = session_lifetime
+        db.touch_interval = float(env.get("BOUNCER_TOUCH_INTERVAL_ODOO", 60))
+
+    # Pending security codes
+    # 'store' keeps them in the session store ('sqlite' is the old name),
+    # 'memory' avoids a disk write per login
+    challenge_store = env.get("BOUNCER_CHALLENGE_STORE_ODOO", "store").lower()
+    if challenge_store == "memory":
+        if WORKERS != 1 or db.lookup_on_miss:
+            sys.exit(
+                "BOUNCER_CHALLENGE_STORE_ODOO=memory requires a single worker"
+                " and a store that is not shared"
+            )
+        challenges = MemoryChallenges(db)
+    elif challenge_store in ("store", "sqlite"):
+        challenges = db
+    else:
+        sys.exit("Unknown BOUNCER_CHALLENGE_STORE_ODOO: {}".format(challenge_store))
+
+    # Signed session tokens
+    # bouncers that share the secret accept each other's tokens
+    token_secret = (
+        env.get("BOUNCER_TOKEN_SECRET_ODOO") or "session-token:" + hotp_secret
+    )
+    signer = None
+    if SIGNED_TOKENS:
+        signer = TokenSigner(token_secret, session_lifetime, name)
+        db.removal_listeners.append(signer.revoke)
+        # loaded again after a restart, see fetch_removals
+        db.keep_removals = session_lifetime
+
+    # Email
+    # load and check email settings
+    smtp_ssl = env.get("BOUNCER_SMTP_SSL_ODOO")
+    email = Email(
+        env.get("BOUNCER_SMTP_SERVER_ODOO"),
+        env.get("BOUNCER_SMTP_PORT_ODOO", 465 if smtp_ssl else 25),
+        ssl=smtp_ssl,
+        user=env.get("BOUNCER_SMTP_USER_ODOO"),
+        password=env.get("BOUNCER_SMTP_PASS_ODOO"),
+        sender=env.get("BOUNCER_SMTP_FROM_ODOO"),
+        admin_user=env.get("BOUNCER_ADMIN_USER_ODOO", "admin"),
+        admin_to=env.get("BOUNCER_SMTP_TO_ODOO"),
+        branding=env.get("BOUNCER_BRANDING_ODOO", ""),
+        # logged in SMTP connections kept open for reuse
+        pool_size=int(env.get("BOUNCER_SMTP_POOL_SIZE_ODOO", 4)),
+        pool_idle=SMTP_POOL_IDLE,
+    )
+    disable_email = env.get("BOUNCER_DISABLE_EMAIL_ODOO", "false").lower() == "true"
+
+    # Odoo
+    # check Odoo settings
+    odoo_url = env.get("BOUNCER_ODOO_URL_ODOO", "http://localhost:8069")
+    if odoo_url.endswith("/"):
+        odoo_url = odoo_url[:-1]
+    odoo_database = env.get("BOUNCER_ODOO_DATABASE_ODOO")
+    if not odoo_database:
+        sys.exit("Odoo settings of {} not set".format(name))
+    auth_params = {
+        "url": odoo_url + "/web/session/authenticate",
+        "url_punchout_login": odoo_url + "/punchouttokenlogin",
+        "url_punchout_signup": odoo_url + "/punchout/signup",
+        "url_jsonrpc": odoo_url + "/jsonrpc",
+        "database": odoo_database,
+        # connection pool towards Odoo
+        "max_connections": int(env.get("BOUNCER_ODOO_MAX_CONNECTIONS_ODOO", 100)),
+        "max_keepalive_connections": int(
+            env.get("BOUNCER_ODOO_KEEPALIVE_CONNECTIONS_ODOO", 20)
+        ),
+        "keepalive_expiry": float(env.get("BOUNCER_ODOO_KEEPALIVE_EXPIRY_ODOO", 30)),
+        "connect_timeout": float(env.get("BOUNCER_ODOO_CONNECT_TIMEOUT_ODOO", 5)),
+        "read_timeout": float(env.get("BOUNCER_ODOO_READ_TIMEOUT_ODOO", 20)),
+        "http2": env.get("BOUNCER_ODOO_HTTP2_ODOO", "false").lower() == "true",
+        # stop calling Odoo for a while when this share of the last calls failed
+        "breaker_rate": float(env.get("BOUNCER_ODOO_BREAKER_RATE_ODOO", 0.5)),
+        "breaker_calls": int(env.get("BOUNCER_ODOO_BREAKER_CALLS_ODOO", 10)),
+        "breaker_reset": float(env.get("BOUNCER_ODOO_BREAKER_RESET_ODOO", 30)),
+    }
+    odoo = OdooAuthHandler(
+        auth_params, "Odoo" if name == "default" else "Odoo of {}".format(name)
+    )
+
+    # Branding
+    # load and check branding settings
+    theme_params = {
+        "backgroundcolor": env.get("BOUNCER_BACKGROUND_COLOR_ODOO", ""),
+        "buttoncolor": env.get("BOUNCER_BUTTON_COLOR_ODOO", ""),
+        "buttonshadowcolor": env.get("BOUNCER_BUTTON_SHADOW_COLOR_ODOO", ""),
+        "buttonhovercolor": env.get("BOUNCER_BUTTON_HOVER_COLOR_ODOO", ""),
+        "branding": env.get("BOUNCER_BRANDING_ODOO", ""),
+    }
+
+    return Tenant(
+        name,
+        hosts,
+        db,
+        challenges,
+        odoo,
+        email,
+        theme_params,
+        hotp_secret,
+        expiry_interval,
+        disable_email=disable_email,
+        signer=signer,
+    )
+
+
+# Tenants
+# the instance of .env answers requests for all hosts not claimed by another
+SESSION_PREFIX = os.environ.get("BOUNCER_SESSION_PREFIX_ODOO", "bouncer:")
+default_tenant = load_tenant(
+    "default", dict(os.environ, BOUNCER_SESSION_PREFIX_ODOO=SESSION_PREFIX)
+)
+tenants = Tenants(default_tenant)
+if TENANTS_DIR:
+    for filename in sorted(os.listdir(TENANTS_DIR)):
+        name, ext = os.path.splitext(filename)
+        if ext != ".env":
+            continue
+        if not re.match(r"^[a-z0-9_-]+$", name) or name == "default":
+            sys.exit("Invalid tenant name: {}".format(filename))
+        values = dotenv_values(os.path.join(TENANTS_DIR, filename))
+        if not values.get("BOUNCER_HOSTS_ODOO"):
+            sys.exit("BOUNCER_HOSTS_ODOO not set in {}".format(filename))
+        # settings missing from the file are taken from .env, but sessions
+        # are always kept apart
+        env = dict(os.environ, BOUNCER_SESSION_PREFIX_ODOO=SESSION_PREFIX + name + ":")
+        env.update((key, value) for key, value in values.items() if value is not None)
+        # HOTP codes and signed tokens of one tenant must not be valid at
+        # another, so secrets taken from .env are made the tenant's own
+        for key in ("BOUNCER_HOTP_SECRET_ODOO", "BOUNCER_TOKEN_SECRET_ODOO"):
+            if not values.get(key) and os.environ.get(key):
+                env[key] = tenant_secret(os.environ[key], name)
+        try:
+            tenants.add(load_tenant(name, env))
+        except ValueError as e:
+            sys.exit(str(e))
+    hotp_secrets = [tenant.hotp_secret.upper() for tenant in tenants]
+    if len(set(hotp_secrets)) != len(hotp_secrets):
+        sys.exit("Every tenant needs its own BOUNCER_HOTP_SECRET_ODOO")
+
+# Outbox of security codes, shared by all tenants
+outbox = None
+if EMAIL_OUTBOX:
+    outbox_path = config_file("outbox.db")
+    outbox = Outbox(
+        outbox_path,
+        {tenant.name: tenant.email for tenant in tenants},
+        # mails sent at the same time by each worker
+        concurrency=int(os.environ.get("BOUNCER_OUTBOX_CONCURRENCY_ODOO", 4)),
+        # attempts before giving up on a mail, the first retry after
+        # BOUNCER_OUTBOX_BACKOFF_ODOO seconds, doubling after each
+        retries=int(os.environ.get("BOUNCER_OUTBOX_RETRIES_ODOO", 5)),
+        backoff=float(os.environ.get("BOUNCER_OUTBOX_BACKOFF_ODOO", 2)),
+    )
+    check_permissions(outbox_path)
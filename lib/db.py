@@ -1,192 +1,495 @@
-import dateutil.parser
-import random
+import asyncio
+import heapq
+import os
 import sqlite3
-import string
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
 
+from lib import metrics, tracing
+from lib.challenges import MAX_CODE_FAILURES, random_code
+from lib.sessionstore import SessionStore
 
-class DB(object):
-    """DB initializes and manipulates SQLite3 databases."""
 
-    session_cache = {}
+# Applied to every new connection. WAL lets the readers of other workers
+# continue while we write, and with synchronous=normal a commit no longer
+# waits for an fsync; a power loss may only lose the last few commits.
+PRAGMAS = (
+    "pragma journal_mode = wal",
+    "pragma synchronous = normal",
+    "pragma busy_timeout = 5000",
+    "pragma temp_store = memory",
+    "pragma cache_size = -8000",
+)
+
+# Bumped by migrate() when existing databases need to be converted
+SCHEMA_VERSION = 4
+
+# Expired rows are deleted this many at a time, each batch in its own
+# short transaction, so cleanup never holds the write lock for long
+CLEANUP_BATCH_SIZE = 500
+CLEANUP_STATEMENTS = (
+    """
+    delete from hotp_codes where id in (
+        select id from hotp_codes
+        where expiry < cast(strftime('%s', 'now') as integer) limit :limit
+    )
+    """,
+    """
+    delete from odoo_sessions where id in (
+        select id from odoo_sessions
+        where expiry < cast(strftime('%s', 'now') as integer) limit :limit
+    )
+    """,
+    # Workers sync every few seconds, older events are not needed, except
+    # logouts for as long as they are remembered
+    """
+    delete from session_events where id in (
+        select id from session_events
+        where created < cast(strftime('%s', 'now') as integer) - 3600
+        and (
+            expiry is not null
+            or created < cast(strftime('%s', 'now') as integer) - :keep_removals
+        )
+        limit :limit
+    )
+    """,
+)
+
+
+class DB(SessionStore):
+    """DB initializes and manipulates SQLite3 databases.
+
+    Queries run on a single dedicated thread, over one long-lived
+    connection per process. The public methods are coroutines, so
+    request handlers never block the IO loop on disk access.
+    """
 
     def __init__(self, database="database.db", statements=[]):
         """Initialize a new or connect to an existing database."""
 
+        super().__init__()
         self.database = database
+        self.con = None
+        self.con_pid = None
+        self.executor = None
+        self.executor_pid = None
         self.create_tables()
+        self.migrate()
+        self.last_event_id = self.max_event_id()
         self.load_sessions()
 
-    def remove_session(self, session):
-        self.session_cache.pop(session)
-        con = self.connect()
-        cur = con.cursor()
-        cur.execute(
-            """
-            delete from odoo_sessions where session_id = ?
-        """,
-            (session,),
-        )
-        con.commit()
-        con.close()
-
-    def verify_session(self, session):
-        session_data = self.session_cache.get(session)
-        if not session_data:
-            return False
-        expiry = session_data.get("expiry")
-        if expiry < datetime.utcnow():
-            return False
-        return True
+    async def execute(self, func, *args):
+        """Run func on the database thread and return its result."""
+
+        # A forked worker does not inherit the thread, start its own
+        if self.executor_pid != os.getpid():
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+            self.executor_pid = os.getpid()
+        loop = asyncio.get_running_loop()
+        start = perf_counter()
+        try:
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            duration = perf_counter() - start
+            query = func.__name__.lstrip("_")
+            metrics.DB_QUERY_DURATION.observe(duration, query)
+            tracing.record("db", query, duration)
 
     def load_sessions(self):
+        """Load all unexpired sessions into the cache, at once."""
+
         con = self.connect()
         cur = con.cursor()
         cur.execute(
             """
-            select session_id, expiry from odoo_sessions
+            select expiry, session_id from odoo_sessions
+            where expiry >= cast(strftime('%s', 'now') as integer)
         """
         )
-        for row in cur:
-            session = row[0]
-            expiry = row[1]
-            self.session_to_cache(session, expiry)
-        con.close()
-
-    def session_to_cache(self, session, expiry_string):
-        # decode string to python datetime
-        expiry = dateutil.parser.parse(expiry_string)
-        self.session_cache[session] = {"expiry": expiry}
-
-    def save_session(self, session, interval):
+        heap = cur.fetchall()
+        self.session_cache.update((session, expiry) for expiry, session in heap)
+        heap.extend(self.session_expiry)
+        heapq.heapify(heap)
+        self.session_expiry[:] = heap
+
+    async def fetch_session(self, session):
+        return await self.execute(self._load_session, session)
+
+    def _load_session(self, session):
         con = self.connect()
         cur = con.cursor()
         cur.execute(
             """
-            delete from odoo_sessions where session_id = ?
-            """,
-            (session,)
+            select expiry from odoo_sessions where session_id = ?
+        """,
+            (session,),
         )
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    def max_event_id(self):
+        con = self.connect()
+        cur = con.cursor()
         cur.execute(
             """
-            insert into odoo_sessions (session_id, expiry)
-            select ?, datetime(datetime(), ?)
-            """,
-            (session, interval),
+            select coalesce(max(id), 0) from session_events
+        """
         )
-        _id = cur.lastrowid
+        return cur.fetchone()[0]
+
+    def add_session_event(self, cur, session, expiry):
+        # An event with an empty expiry means the session was removed
         cur.execute(
             """
-            select expiry from odoo_sessions where id = ?
+            insert into session_events (session_id, expiry, created)
+            select ?, ?, cast(strftime('%s', 'now') as integer)
             """,
-            (_id,),
+            (session, expiry),
         )
-        row = cur.fetchone()
-        expiry = row[0]
-        self.session_to_cache(session, expiry)
-        con.commit()
-        con.close()
-        return _id, expiry
 
-    def next_hotp_id(self, session_id):
+    async def fetch_events(self):
+        rows = await self.execute(self._session_events, self.last_event_id)
+        if rows:
+            self.last_event_id = rows[-1][0]
+        return [(session, expiry) for _id, session, expiry in rows]
+
+    def _session_events(self, last_event_id):
         con = self.connect()
         cur = con.cursor()
-        # A random code to be provided by the form
-        code = "".join(
-            random.SystemRandom().choice(string.ascii_uppercase + string.digits)
-            for _ in range(16)
-        )
         cur.execute(
             """
-            insert into hotp_codes (expiry, code, session_id)
-            select datetime(datetime(), '+15 minutes'), ?, ?
+            select id, session_id, expiry from session_events
+            where id > ? order by id
         """,
-            (code, session_id),
+            (last_event_id,),
         )
-        _id = cur.lastrowid
-        con.commit()
-        con.close()
-        return _id, code
+        return cur.fetchall()
 
-    def verify_code_and_expiry(self, counter, code):
-        # Verify random code provided by form
+    async def fetch_removals(self):
+        rows = await self.execute(self._removals, self.keep_removals)
+        return [(session, created + self.keep_removals) for session, created in rows]
+
+    def _removals(self, keep_removals):
         con = self.connect()
         cur = con.cursor()
         cur.execute(
             """
-            select id, session_id from hotp_codes
-            where id = ? and code = ? and expiry > datetime('now')
+            select session_id, created from session_events
+            where expiry is null
+            and created >= cast(strftime('%s', 'now') as integer) - ?
         """,
-            (
-                counter,
-                code,
-            ),
+            (keep_removals,),
         )
-        row = cur.fetchone()
-        if row:
+        return cur.fetchall()
+
+    async def store_sessions(self, writes):
+        await self.execute(self._write_sessions, writes)
+
+    async def store_touches(self, touches):
+        await self.execute(self._touch_sessions, touches)
+
+    def _touch_sessions(self, touches):
+        con = self.connect()
+        with con:
+            # Never brings back a removed session, nor shortens one
+            con.executemany(
+                """
+                update odoo_sessions set expiry = ?
+                where session_id = ? and expiry < ?
+            """,
+                [(expiry, session, expiry) for session, expiry in touches],
+            )
+
+    def _write_sessions(self, writes):
+        con = self.connect()
+        with con:
+            cur = con.cursor()
+            for session, expiry in writes:
+                if expiry is None:
+                    cur.execute(
+                        """
+                        delete from odoo_sessions where session_id = ?
+                    """,
+                        (session,),
+                    )
+                else:
+                    cur.execute(
+                        """
+                        insert or replace into odoo_sessions (session_id, expiry)
+                        values (?, ?)
+                    """,
+                        (session, expiry),
+                    )
+                self.add_session_event(cur, session, expiry)
+
+    async def next_hotp_id(self, session_id, payload=None, username=None):
+        """Issue a security code for a session.
+
+        The payload, text to be returned once the code is verified, is kept
+        along with the session, and so is the username it was issued to.
+        """
+        return await self.execute(self._next_hotp_id, session_id, payload, username)
+
+    def _next_hotp_id(self, session_id, payload, username):
+        con = self.connect()
+        code = random_code()
+        with con:
+            cur = con.cursor()
             cur.execute(
                 """
-                delete from hotp_codes where id = ?
+                insert into hotp_codes (expiry, code, session_id, payload, username)
+                select cast(strftime('%s', 'now') as integer) + 15 * 60, ?, ?, ?, ?
             """,
-                (row[0],),
+                (code, session_id, payload, username),
             )
-            con.commit()
-            session_id = row[1]
-        else:
-            session_id = False
-        con.close()
-        return session_id
-
-    def cleanup(self):
-        # Cleanup: clear expired tokens, etc
+            _id = cur.lastrowid
+        return _id, code
+
+    async def reserve_hotp_ids(self, count):
+        return await self.execute(self._reserve_hotp_ids, count)
+
+    def _reserve_hotp_ids(self, count):
+        """Reserve a block of HOTP counters, return the first one.
+
+        Bumps the autoincrement sequence of hotp_codes, so counters given
+        out from memory and from the table never overlap, across restarts.
+        """
+
         con = self.connect()
-        cur = con.cursor()
-        cur.execute(
+        with con:
+            cur = con.cursor()
+            cur.execute(
+                """
+                update sqlite_sequence
+                set seq = max(seq, (select coalesce(max(id), 0) from hotp_codes)) + ?
+                where name = 'hotp_codes'
+            """,
+                (count,),
+            )
+            if not cur.rowcount:
+                cur.execute(
+                    """
+                    insert into sqlite_sequence (name, seq)
+                    select 'hotp_codes', coalesce(max(id), 0) + ? from hotp_codes
+                """,
+                    (count,),
+                )
+            cur.execute(
+                """
+                select seq from sqlite_sequence where name = 'hotp_codes'
             """
-            delete from hotp_codes where expiry < datetime('now')
+            )
+            return cur.fetchone()[0] - count + 1
+
+    async def verify_code_and_expiry(self, counter, code):
+        """Return the session, payload and username of a code.
+
+        (False, None, None) if the code is invalid.
         """
-        )
-        cur.execute(
-            """
-            delete from odoo_sessions where expiry < datetime('now')
+        return await self.execute(self._verify_code_and_expiry, counter, code)
+
+    def _verify_code_and_expiry(self, counter, code):
+        # Verify random code provided by form
+        con = self.connect()
+        with con:
+            cur = con.cursor()
+            cur.execute(
+                """
+                select id, session_id, payload, username from hotp_codes
+                where id = ? and code = ?
+                and expiry > cast(strftime('%s', 'now') as integer)
+            """,
+                (
+                    counter,
+                    code,
+                ),
+            )
+            row = cur.fetchone()
+            if row:
+                cur.execute(
+                    """
+                    delete from hotp_codes where id = ?
+                """,
+                    (row[0],),
+                )
+                return row[1], row[2], row[3]
+        return False, None, None
+
+    async def fail_code(self, counter, code):
+        """Count a wrong security code, drop the challenge after too many.
+
+        Return the username of the challenge, None if there is none.
         """
-        )
-        con.commit()
-        con.close()
+        return await self.execute(self._fail_code, counter, code)
+
+    def _fail_code(self, counter, code):
+        con = self.connect()
+        with con:
+            cur = con.cursor()
+            cur.execute(
+                """
+                update hotp_codes set failures = failures + 1
+                where id = ? and code = ?
+            """,
+                (counter, code),
+            )
+            if not cur.rowcount:
+                return None
+            cur.execute(
+                """
+                select username from hotp_codes where id = ?
+            """,
+                (counter,),
+            )
+            (username,) = cur.fetchone()
+            cur.execute(
+                """
+                delete from hotp_codes where id = ? and code = ? and failures >= ?
+            """,
+                (counter, code, MAX_CODE_FAILURES),
+            )
+        return username
+
+    async def cleanup(self):
+        # Cleanup: clear expired tokens, etc
+        await super().cleanup()
+        for statement in CLEANUP_STATEMENTS:
+            while True:
+                deleted = await self.execute(
+                    self._cleanup, statement, CLEANUP_BATCH_SIZE, self.keep_removals
+                )
+                if deleted < CLEANUP_BATCH_SIZE:
+                    break
+
+    def _cleanup(self, statement, batch_size, keep_removals):
+        con = self.connect()
+        with con:
+            cur = con.cursor()
+            cur.execute(statement, {"limit": batch_size, "keep_removals": keep_removals})
+        return cur.rowcount
 
     def create_tables(self):
         con = self.connect()
-        cur = con.cursor()
-        cur.execute(
+        with con:
+            cur = con.cursor()
+            cur.execute(
+                """
+                create table if not exists hotp_codes (
+                    id integer primary key autoincrement,
+                    expiry integer,
+                    code character(16),
+                    session_id character(20),
+                    payload text,
+                    failures integer not null default 0,
+                    username text
+                )
             """
-            create table if not exists hotp_codes (
-                id integer primary key autoincrement,
-                expiry datetime,
-                code character(16),
-                session_id character(20)
             )
-        """
-        )
-        cur.execute(
+            cur.execute(
+                """
+                create table if not exists odoo_sessions (
+                    id integer primary key autoincrement,
+                    session_id character(20),
+                    expiry integer
+                )
             """
-            create table if not exists odoo_sessions (
-                id integer primary key autoincrement,
-                session_id character(20),
-                expiry datetime
             )
-        """
-        )
-        cur.execute(
+            cur.execute(
+                """
+                create unique index if not exists idx_session_id
+                on odoo_sessions (session_id)
+            """
+            )
+            cur.execute(
+                """
+                create table if not exists session_events (
+                    id integer primary key autoincrement,
+                    session_id character(20),
+                    expiry integer,
+                    created integer
+                )
+            """
+            )
+            # Let cleanup find expired rows without a table scan
+            cur.execute(
+                """
+                create index if not exists idx_hotp_codes_expiry
+                on hotp_codes (expiry)
+            """
+            )
+            cur.execute(
+                """
+                create index if not exists idx_odoo_sessions_expiry
+                on odoo_sessions (expiry)
+            """
+            )
+            cur.execute(
+                """
+                create index if not exists idx_session_events_created
+                on session_events (created)
             """
-            create unique index if not exists idx_session_id
-            on odoo_sessions (session_id)
+            )
+
+    def migrate(self):
+        """Convert a database created by an older version of the bouncer.
+
+        Version 1 stores times as seconds since the epoch instead of text,
+        so loading sessions needs no date parsing. Version 2 keeps the Odoo
+        login response with a security code, version 3 counts wrong codes
+        and version 4 keeps the username they were sent to.
         """
-        )
-        con.commit()
-        con.close()
+
+        con = self.connect()
+        version = con.execute("pragma user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        with con:
+            cur = con.cursor()
+            # Both steps leave converted databases as they are
+            for table, column in (
+                ("hotp_codes", "expiry"),
+                ("odoo_sessions", "expiry"),
+                ("session_events", "expiry"),
+                ("session_events", "created"),
+            ):
+                cur.execute(
+                    f"""
+                    update {table}
+                    set {column} = cast(strftime('%s', {column}) as integer)
+                    where typeof({column}) = 'text'
+                """
+                )
+            columns = [row[1] for row in cur.execute("pragma table_info(hotp_codes)")]
+            if "payload" not in columns:
+                cur.execute("alter table hotp_codes add column payload text")
+            if "failures" not in columns:
+                cur.execute(
+                    "alter table hotp_codes add column failures integer not null default 0"
+                )
+            if "username" not in columns:
+                cur.execute("alter table hotp_codes add column username text")
+            cur.execute(f"pragma user_version = {SCHEMA_VERSION}")
 
     def connect(self):
-        """Connect to the SQLite3 database."""
+        """Connect to the SQLite3 database, once per process.
+
+        A connection must not be shared with a forked worker, so a new
+        one is opened when the process id changes.
+        """
+
+        if self.con_pid != os.getpid():
+            self.con = sqlite3.connect(self.database, check_same_thread=False)
+            for pragma in PRAGMAS:
+                self.con.execute(pragma)
+            self.con_pid = os.getpid()
+        return self.con
+
+    def close_before_fork(self):
+        """Close the connection of the parent, workers open their own."""
+
+        if self.con is not None:
+            self.con.close()
+        self.con = None
+        self.con_pid = None
 
-        return sqlite3.connect(self.database)
@@ -1,7 +1,11 @@
 import aiosmtplib
-import lib.config as config
+import asyncio
+import lib.metrics as metrics
+import lib.tracing as tracing
 import logging
+import os
 import re
+import time
 
 from email.mime.text import MIMEText
 
@@ -9,96 +13,185 @@ from email.mime.text import MIMEText
 EMAIL_TIMEOUT = 20
 
 
-class email:
-    connected = False
+class Email:
+    """Sends security codes through one SMTP server.
+
+    Each instance keeps its own pool of logged in connections.
+    """
+
     email_regex = re.compile(r"^[A-Za-z0-9\.\+_-]+@[A-Za-z0-9\._-]+\.[a-zA-Z]*$")
 
-    async def connect():
-        if config.SMTP_SSL:
-            s = aiosmtplib.SMTP(
-                config.SMTP_SERVER, config.SMTP_PORT, timeout=EMAIL_TIMEOUT, use_tls=True
-            )
-        else:
-            s = aiosmtplib.SMTP(
-                config.SMTP_SERVER, config.SMTP_PORT, timeout=EMAIL_TIMEOUT, use_tls=False
-            )
+    def __init__(
+        self,
+        server,
+        port,
+        ssl=False,
+        user=None,
+        password=None,
+        sender=None,
+        admin_user="admin",
+        admin_to=None,
+        branding="",
+        pool_size=4,
+        pool_idle=60,
+    ):
+        self.server = server
+        self.port = port
+        self.ssl = ssl
+        self.user = user
+        self.password = password
+        self.sender = sender
+        # Codes for the admin user go to this address instead
+        self.admin_user = admin_user
+        self.admin_to = admin_to
+        self.branding = branding
+        self.pool_size = pool_size
+        self.pool_idle = pool_idle
+        # Idle, logged in connections as (smtp, last used) tuples
+        self.pool = []
+        self.pool_pid = None
+        # Limits the number of connections open at the same time
+        self.semaphore = None
+
+    async def connect(self):
+        s = aiosmtplib.SMTP(
+            self.server, self.port, timeout=EMAIL_TIMEOUT, use_tls=bool(self.ssl)
+        )
         await s.connect()
         return s
 
-    async def login(s):
-        if config.SMTP_USER:
-            await s.login(config.SMTP_USER, config.SMTP_PASS, timeout=EMAIL_TIMEOUT)
+    async def login(self, s):
+        if self.user:
+            await s.login(self.user, self.password, timeout=EMAIL_TIMEOUT)
         return
 
-    async def full_connect():
+    def check_pid(self):
+        # A forked worker must not use the connections of its parent
+        if self.pool_pid != os.getpid():
+            self.pool = []
+            self.semaphore = asyncio.Semaphore(self.pool_size)
+            self.pool_pid = os.getpid()
+
+    async def acquire(self):
+        """Return a logged in connection, reusing an idle one if possible."""
+        self.check_pid()
+        await self.semaphore.acquire()
         try:
-            logging.info(
-                "Connecting to SMTP server {}:{}...".format(
-                    config.SMTP_SERVER, config.SMTP_PORT
-                )
-            )
-            s = await email.connect()
-            await email.login(s)
+            while self.pool:
+                s, last_used = self.pool.pop()
+                if time.monotonic() - last_used > self.pool_idle:
+                    s.close()
+                    continue
+                try:
+                    await s.noop(timeout=EMAIL_TIMEOUT)
+                    return s
+                except (aiosmtplib.SMTPException, OSError):
+                    s.close()
+            logging.info("Connecting to SMTP server {}:{}...".format(self.server, self.port))
+            s = await self.connect()
+            await self.login(s)
+            return s
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+    def release(self, s, reuse=True):
+        """Put a connection back into the pool, or close it."""
+        self.semaphore.release()
+        if reuse and s.is_connected and len(self.pool) < self.pool_size:
+            self.pool.append((s, time.monotonic()))
+        else:
             s.close()
-            email.connected = True
-        except aiosmtplib.SMTPServerDisconnected:
-            logging.info("...timed out. Please check your SMTP settings in .env")
-        except Exception as e:
-            logging.info(str(e))
 
-    async def test():
-        if not config.SMTP_SERVER or not config.SMTP_FROM:
-            sys.exit("SMTP settings not set in .env")
+    async def expire_idle(self):
+        """Close connections that have not been used for a while."""
+        self.check_pid()
+        now = time.monotonic()
+        idle = []
+        for s, last_used in self.pool:
+            if now - last_used > self.pool_idle:
+                s.close()
+            else:
+                idle.append((s, last_used))
+        self.pool = idle
 
+    async def close(self):
+        self.check_pid()
+        while self.pool:
+            s, last_used = self.pool.pop()
+            try:
+                await s.quit(timeout=EMAIL_TIMEOUT)
+            except (aiosmtplib.SMTPException, OSError):
+                pass
+            s.close()
+
+    async def test(self):
+        """Log in to the SMTP server, and keep the connection for later."""
+        if not self.server or not self.sender:
+            logging.warning("SMTP settings not set in .env")
+            return
         try:
-            logging.info(
-                "Connecting to SMTP server {}:{}...".format(
-                    config.SMTP_SERVER, config.SMTP_PORT
-                )
-            )
-            s = await email.connect()
-        except aiosmtplib.SMTPServerDisconnected:
-            logging.warning("...timed out. Please check your SMTP settings in .env")
-        await email.login(s)
-        s.close()
-
-    async def send(username, code):
-        if not email.connected:
-            await email.full_connect()
-        if (username == config.ADMIN_USER) and config.SMTP_TO:
-            _to = config.SMTP_TO
+            self.release(await self.acquire())
+        except (aiosmtplib.SMTPException, OSError):
+            logging.warning("...failed. Please check your SMTP settings in .env")
+
+    def recipients(self, username):
+        """The addresses that codes for username go to, or None if invalid."""
+        if (username == self.admin_user) and self.admin_to:
+            _to = self.admin_to
         else:
             _to = username
+        if not _to:
+            return None
+        if not all(self.email_regex.match(t) for t in _to.split(",")):
+            return None
+        return _to
+
+    async def send(self, username, code, retries=3):
+        """Send the code, trying up to `retries` times when the server
+        disconnects or times out."""
+        _to = self.recipients(username)
         if not _to:
             return False
         _to_list = _to.split(",")
-        if not all(email.email_regex.match(t) for t in _to_list):
-            return False
-        if config.BRANDING:
-            msgtext = "{} security code: {}".format(config.BRANDING, code)
+        if self.branding:
+            msgtext = "{} security code: {}".format(self.branding, code)
         else:
             msgtext = "Security code: {}".format(code)
         msg = MIMEText(msgtext)
         msg["Subject"] = msgtext
-        msg["From"] = config.SMTP_FROM
+        msg["From"] = self.sender
         msg["To"] = _to
         s = None
-        retries = 3
+        attempts = retries
         success = False
+        start = time.perf_counter()
         logging.info("Trying to send mail..")
         while (not success) and retries > 0:
             try:
-                s = await email.connect()
-                await email.login(s)
-                await s.sendmail(config.SMTP_FROM, _to_list, msg.as_string(), timeout=EMAIL_TIMEOUT)
-                await s.quit()
-                s.close()
+                s = await self.acquire()
+            except (aiosmtplib.SMTPServerDisconnected, aiosmtplib.errors.SMTPReadTimeoutError):
+                metrics.SMTP_RETRIES.inc()
+                retries -= 1
+                continue
+            try:
+                await s.sendmail(self.sender, _to_list, msg.as_string(), timeout=EMAIL_TIMEOUT)
+                self.release(s)
                 success = True
                 break
             except (aiosmtplib.SMTPServerDisconnected, aiosmtplib.errors.SMTPReadTimeoutError):
+                self.release(s, reuse=False)
+                metrics.SMTP_RETRIES.inc()
                 retries -= 1
+            except BaseException:
+                self.release(s, reuse=False)
+                raise
+        duration = time.perf_counter() - start
+        metrics.SMTP_SEND_DURATION.observe(duration)
+        tracing.record("smtp", None, duration)
         if not success:
-            logging.error("SMTP failed after three retries")
+            metrics.SMTP_FAILURES.inc()
+            logging.error("SMTP failed after %d attempts", attempts)
             return False
         logging.info("Mail with security code sent to %s", _to)
         return True
@@ -0,0 +1,171 @@
+#!/bin/env python
+# Copyright 2020 Sunflower IT
+
+import asyncio
+import httpx
+import logging
+import random
+
+from time import perf_counter, time
+from tornado import httputil
+
+from lib import metrics
+
+
+AUTH_PATHS = ("/auth", "/auth/")
+
+access_log = logging.getLogger("bouncer.auth")
+
+
+def cookie_value(header, name):
+    """Return a cookie from a Cookie header, the last one wins."""
+    result = None
+    for chunk in header.split(";"):
+        key, sep, value = chunk.partition("=")
+        if sep and key.strip() == name:
+            result = value.strip()
+    return result
+
+
+def cache_seconds(valid, expiry, cache_max):
+    """How long NGINX may cache an answer, never beyond the session expiry."""
+    if not valid or expiry is None:
+        return 0
+    return max(0, int(min(cache_max, expiry - time())))
+
+
+async def purge_cached(url, cookie, host=None):
+    """Ask NGINX to forget the cached answers for a Cookie header."""
+    headers = {"Cookie": cookie or ""}
+    if host:
+        # Cached by host as well, when several Odoo instances are served
+        headers["Host"] = host
+    try:
+        async with httpx.AsyncClient(timeout=5) as client:
+            resp = await client.request("PURGE", url, headers=headers)
+    except httpx.HTTPError as e:
+        logging.warning("Purging cached session failed: %r", e)
+        return
+    # ngx_cache_purge answers 404 when nothing was cached
+    if resp.status_code not in (200, 404):
+        logging.warning("Purging cached session failed: %s", resp.status_code)
+
+
+class AuthRouter(httputil.HTTPServerConnectionDelegate):
+    """Answers nginx auth_request subrequests on /auth directly.
+
+    NGINX sends a subrequest for every single Odoo request, so /auth
+    skips the RequestHandler machinery, cookie objects and access log;
+    all other requests are passed to the tornado application. Sessions
+    are checked in the store of the tenant of the Host header.
+    With cache_max, valid answers carry X-Accel-Expires, so that NGINX
+    may cache them for that many seconds at most. A share of log_rate
+    of the requests is logged.
+    """
+
+    def __init__(self, app, tenants, failure_log=None, cache_max=0, log_rate=0):
+        self.app = app
+        self.tenants = tenants
+        self.failure_log = failure_log
+        self.cache_max = cache_max
+        self.log_rate = log_rate
+
+    def start_request(self, server_conn, request_conn):
+        return AuthRequest(self, server_conn, request_conn)
+
+    def on_close(self, server_conn):
+        self.app.on_close(server_conn)
+
+
+class AuthRequest(httputil.HTTPMessageDelegate):
+
+    def __init__(self, router, server_conn, request_conn):
+        self.router = router
+        self.server_conn = server_conn
+        self.request_conn = request_conn
+        self.delegate = None
+        self.tenant = None
+        self.session = None
+        self.token = None
+        self.start = None
+
+    def headers_received(self, start_line, headers):
+        if (
+            start_line.method in ("GET", "HEAD")
+            and start_line.path.partition("?")[0] in AUTH_PATHS
+        ):
+            self.start = perf_counter()
+            self.tenant = self.router.tenants.for_host(headers.get("Host"))
+            cookie = headers.get("Cookie", "")
+            self.session = cookie_value(cookie, "session_id")
+            # With signed tokens, the session store is not needed at all
+            if self.tenant.signer:
+                self.token = cookie_value(cookie, self.tenant.signer.cookie_name)
+            return None
+        self.delegate = self.router.app.start_request(
+            self.server_conn, self.request_conn
+        )
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        if self.delegate:
+            return self.delegate.data_received(chunk)
+        return None
+
+    def finish(self):
+        if self.delegate:
+            return self.delegate.finish()
+        if self.tenant.signer:
+            expiry = self.tenant.signer.valid_until(self.token, self.session)
+            return self.respond(expiry is not None, expiry)
+        valid = self.tenant.db.check_session(self.session)
+        if valid is None:
+            # Only the database knows, answer when it does
+            asyncio.ensure_future(self.verify())
+        else:
+            self.respond(valid, self.tenant.db.session_cache.get(self.session))
+
+    def on_connection_close(self):
+        if self.delegate:
+            return self.delegate.on_connection_close()
+
+    async def verify(self):
+        try:
+            valid = await self.tenant.db.verify_session(self.session)
+        except Exception:
+            # NGINX waits for an answer, and must not cache this one
+            logging.exception("Verifying session failed")
+            return self.respond(False, error=True)
+        self.respond(valid, self.tenant.db.session_cache.get(self.session))
+
+    def respond(self, valid, expiry=None, error=False):
+        if error:
+            start_line = httputil.ResponseStartLine(
+                "HTTP/1.1", 500, "Internal Server Error"
+            )
+        elif valid:
+            start_line = httputil.ResponseStartLine("HTTP/1.1", 200, "OK")
+        else:
+            start_line = httputil.ResponseStartLine("HTTP/1.1", 401, "Unauthorized")
+        headers = httputil.HTTPHeaders({"Content-Length": "0"})
+        if self.router.cache_max or error:
+            headers["X-Accel-Expires"] = str(
+                cache_seconds(valid, expiry, self.router.cache_max)
+            )
+        self.request_conn.write_headers(start_line, headers)
+        self.request_conn.finish()
+        if not valid and not error and self.router.failure_log:
+            self.router.failure_log.record((self.session or "")[:8])
+        duration = perf_counter() - self.start
+        # Named after the handler that used to answer /auth, for dashboards
+        metrics.REQUESTS.inc("VerifySessionHandler", start_line.code)
+        metrics.REQUEST_DURATION.observe(duration, "VerifySessionHandler")
+        if self.router.log_rate and random.random() < self.router.log_rate:
+            access_log.info(
+                "status=%d duration_ms=%.2f tenant=%s session=%s sample_rate=%g",
+                start_line.code,
+                duration * 1000,
+                self.tenant.name,
+                (self.session or "")[:8],
+                self.router.log_rate,
+            )
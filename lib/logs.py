@@ -0,0 +1,72 @@
+#!/bin/env python
+# Copyright 2020 Sunflower IT
+
+"""Logging through a queue, written to stderr by a background thread.
+
+A slow stderr, such as journald applying back-pressure, then no longer
+stalls the IO loop: a request only puts its records in the queue.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+# Same format as logging.basicConfig
+FORMAT = "%(levelname)s:%(name)s:%(message)s"
+
+queue_handler = None
+listener = None
+
+
+def parse_levels(text):
+    """Parse 'httpx=WARNING,tornado.access=ERROR' into a dict."""
+    levels = {}
+    for item in text.split(","):
+        name, sep, level = item.partition("=")
+        if sep:
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def start():
+    global listener
+    records = queue.SimpleQueue()
+    queue_handler.queue = records
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(FORMAT))
+    listener = logging.handlers.QueueListener(records, stream_handler)
+    listener.start()
+
+
+def stop():
+    """Write what is still queued, and stop the thread."""
+    global listener
+    if listener:
+        listener.stop()
+        listener = None
+
+
+def restart_in_child():
+    # The thread is not forked along, and neither should the records
+    # that the parent still had to write
+    global listener
+    listener = None
+    start()
+
+
+def setup(level="INFO", levels=None):
+    """Send all logging through the queue, with a level per logger name."""
+    global queue_handler
+    queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper())
+    for name, name_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(name_level)
+    start()
+    os.register_at_fork(after_in_child=restart_in_child)
+    atexit.register(stop)
@@ -0,0 +1,143 @@
+#!/bin/env python
+# Copyright 2020 Sunflower IT
+
+"""Counters, gauges and histograms in the Prometheus text format.
+
+Each worker process keeps its own values.
+"""
+
+from bisect import bisect_left
+
+
+# In seconds, from a cached /auth check up to an Odoo timeout
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20
+)
+
+registry = []
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs
+    )
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labels, labels)} {value}"
+
+
+class Gauge:
+    """A value that is computed when the metrics are collected."""
+
+    def __init__(self, name, documentation, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        registry.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {self.function()}"
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [count per bucket, ..., count above last bucket, sum]
+        self.values = {}
+        registry.append(self)
+
+    def observe(self, value, *labels):
+        values = self.values.get(labels)
+        if values is None:
+            values = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        values[bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, values in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                yield "{}_bucket{} {}".format(
+                    self.name,
+                    format_labels(self.labels, labels, [("le", bound)]),
+                    cumulative,
+                )
+            label_text = format_labels(self.labels, labels)
+            yield f"{self.name}_sum{label_text} {values[-1]}"
+            yield f"{self.name}_count{label_text} {cumulative}"
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Requests handled by the bouncer
+REQUESTS = Counter(
+    "bouncer_requests_total", "Requests by handler and status.", ("handler", "code")
+)
+REQUEST_DURATION = Histogram(
+    "bouncer_request_duration_seconds", "Time to handle a request.", ("handler",)
+)
+
+# Odoo upstream
+ODOO_DURATION = Histogram(
+    "bouncer_odoo_request_duration_seconds", "Time of calls to Odoo.", ("call",)
+)
+ODOO_ERRORS = Counter(
+    "bouncer_odoo_errors_total", "Calls to Odoo that failed to connect or timed out.", ("call",)
+)
+ODOO_REJECTED = Counter(
+    "bouncer_odoo_rejected_total", "Calls to Odoo not made while the circuit was open.", ("call",)
+)
+
+# SMTP
+SMTP_SEND_DURATION = Histogram(
+    "bouncer_smtp_send_duration_seconds", "Time to send a security code."
+)
+SMTP_RETRIES = Counter("bouncer_smtp_retries_total", "Failed SMTP attempts that were retried.")
+SMTP_FAILURES = Counter("bouncer_smtp_failures_total", "Security codes that could not be sent.")
+OUTBOX_MAILS = Counter(
+    "bouncer_outbox_mails_total",
+    "Security codes taken from the outbox, by what became of them.",
+    ("status",),
+)
+OUTBOX_DELAY = Histogram(
+    "bouncer_outbox_delay_seconds", "Time from queueing a security code to sending it."
+)
+
+# SQLite
+DB_QUERY_DURATION = Histogram(
+    "bouncer_db_query_duration_seconds",
+    "Time of database calls, including waiting for the database thread.",
+    ("query",),
+)
@@ -1,79 +1,179 @@
 #!/bin/env python
 # Copyright 2020 Sunflower IT
 
-import asyncio
 import httpx
 import logging
+import os
 import random
-import traceback
+import time
 
+from http.cookiejar import CookieJar, DefaultCookiePolicy
 from pprint import pformat
 
+from lib import metrics, tracing
+from lib.breaker import OPEN, CircuitBreaker
+
+
+class OdooUnavailable(Exception):
+    """Odoo could not be reached, or is not asked while the circuit is open."""
+
 
 class OdooAuthHandler:
+    """Calls to one Odoo instance.
+
+    Each instance keeps its own connection pool and circuit breaker, so
+    connections to Odoo are kept alive and reused by all requests.
+    """
 
-    params = {
+    default_params = {
         "url": None,
         "url_punchout_login": None,
         "url_punchout_signup": None,
+        "url_jsonrpc": None,
         "database": None,
+        "max_connections": 100,
+        "max_keepalive_connections": 20,
+        "keepalive_expiry": 30,
+        "connect_timeout": 5,
+        "read_timeout": 20,
+        "http2": False,
     }
 
-    @classmethod
-    def set_params(cls, params):
-        cls.params = params
+    # Every instance of this process, for the circuit metric
+    instances = []
+
+    def __init__(self, params, name="Odoo"):
+        self.params = dict(self.default_params, **params)
+        self.client = None
+        self.client_pid = None
+        self.breaker = CircuitBreaker(
+            name,
+            rate=self.params.get("breaker_rate", 0.5),
+            calls=self.params.get("breaker_calls", 10),
+            reset_timeout=self.params.get("breaker_reset", 30),
+        )
+        self.instances.append(self)
+
+    def get_client(self):
+        if self.client_pid != os.getpid():
+            http2 = self.params.get("http2")
+            if http2:
+                try:
+                    import h2  # noqa: F401
+                except ImportError:
+                    logging.warning("HTTP/2 needs the h2 package, using HTTP/1.1")
+                    http2 = False
+            self.client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.params.get("max_connections"),
+                    max_keepalive_connections=self.params.get("max_keepalive_connections"),
+                    keepalive_expiry=self.params.get("keepalive_expiry"),
+                ),
+                timeout=httpx.Timeout(
+                    self.params.get("read_timeout"),
+                    connect=self.params.get("connect_timeout"),
+                ),
+                http2=http2,
+                # Never remember the session cookie of one user for the next
+                cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+            )
+            self.client_pid = os.getpid()
+        return self.client
 
-    async def request_odoo(self, url, params):
-        async with httpx.AsyncClient(timeout=20) as client:
-            json_payload = {
-                "jsonrpc": "2.0",
-                "method": "call",
-                "params": params,
-                "id": random.randint(0, 1000000000),
-            }
-            return await client.post(url, json=json_payload)
+    async def close(self):
+        if self.client and self.client_pid == os.getpid():
+            await self.client.aclose()
+        self.client = None
+        self.client_pid = None
+
+    async def timed(self, call, request, probe=False):
+        """Await a request to Odoo, and record its duration and errors.
+
+        Raises OdooUnavailable when Odoo cannot be reached, and right away
+        while the circuit is open. A probe is made even then, and closes
+        the circuit when it succeeds.
+        """
+        breaker = self.breaker
+        if not probe and not breaker.allow():
+            request.close()
+            metrics.ODOO_REJECTED.inc(call)
+            raise OdooUnavailable(call)
+        start = time.perf_counter()
+        try:
+            resp = await request
+        except httpx.TransportError as e:
+            metrics.ODOO_ERRORS.inc(call)
+            breaker.failed()
+            logging.warning("Odoo %s call failed: %r", call, e)
+            raise OdooUnavailable(call) from e
+        except BaseException:
+            # Cancelled, let another call probe
+            breaker.probing = False
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            metrics.ODOO_DURATION.observe(duration, call)
+            tracing.record("odoo", call, duration)
+        if resp.status_code >= 500:
+            breaker.failed()
+        else:
+            breaker.succeeded()
+        return resp
+
+    async def request_odoo(self, url, params, call="authenticate", probe=False):
+        client = self.get_client()
+        json_payload = {
+            "jsonrpc": "2.0",
+            "method": "call",
+            "params": params,
+            "id": random.randint(0, 1000000000),
+        }
+        return await self.timed(call, client.post(url, json=json_payload), probe)
 
     async def check_login(self, username, password):
         database = self.params.get("database")
         url = self.params.get("url")
         params = {"db": database, "login": username, "password": password}
-        try:
-            resp = await self.request_odoo(url, params)
-        except (httpx.ConnectError, httpx.TimeoutException):
-            logging.error(traceback.format_exc())
-            return False, False
+        resp = await self.request_odoo(url, params)
+        # Failures are logged at debug level, the caller logs a summary
         if not "session_id" in resp.cookies:
-            logging.info("Authentication failed: session cookie not found")
+            logging.debug("Authentication failed: session cookie not found")
             return False, False
         cookie = resp.cookies["session_id"]
         result = resp.json()
         if not "result" in result:
-            logging.info("Authentication failed")
+            logging.debug("Authentication failed")
             if "error" in result:
-                logging.info(pformat(result["error"]))
+                logging.debug(pformat(result["error"]))
             return False, False
         elif not result["result"].get("uid"):
-            logging.info("Authentication failed: no uid in response")
+            logging.debug("Authentication failed: no uid in response")
             return False, False
         return result, cookie
 
+    async def punchout(self, call, method, url, **kwargs):
+        """Send a punchout request, return the response and its session id.
+
+        Only the headers are read. The caller has to read the body, from
+        resp.aiter_bytes(), and close the response with resp.aclose().
+        """
+        client = self.get_client()
+        request = client.build_request(method, url, **kwargs)
+        resp = await self.timed(call, client.send(request, stream=True))
+        description = call.replace("_", " ")
+        if resp.status_code != 200:
+            logging.info("Authentication failed for %s", description)
+        elif not "session_id" in resp.cookies:
+            logging.info("Session cookie not found for %s", description)
+        else:
+            return resp, resp.cookies["session_id"]
+        await resp.aclose()
+        return False, False
+
     async def punchout_login(self, token):
         url = self.params.get("url_punchout_login")
         params = {"token": token}
-        async with httpx.AsyncClient(timeout=20) as client:
-            try:
-                resp = await client.get(url, params=params)
-            except (httpx.ConnectError, httpx.TimeoutException):
-                logging.error(traceback.format_exc())
-                return False, False
-            if resp.status_code != 200:
-                logging.info("Authentication failed for punchout login")
-                return False, False
-        if not "session_id" in resp.cookies:
-            logging.info("Session cookie not found for punchout login")
-            return False, False
-        cookie = resp.cookies["session_id"]
-        return resp, cookie
+        return await self.punchout("punchout_login", "GET", url, params=params)
 
     async def punchout_signup(self, token, session_id):
         url = self.params.get("url_punchout_signup")
@@ -81,20 +181,9 @@ class OdooAuthHandler:
         cookies = {}
         if session_id:
             cookies["session_id"] = session_id
-        async with httpx.AsyncClient(timeout=20) as client:
-            try:
-                resp = await client.get(url, params=params, cookies=cookies)
-                if resp.status_code != 200:
-                    logging.info("Authentication failed for punchout signup")
-                    return False, False
-            except (httpx.ConnectError, httpx.TimeoutException):
-                logging.error(traceback.format_exc())
-                return False, False
-        if not "session_id" in resp.cookies:
-            logging.info("Session cookie not found for punchout signup")
-            return False, False
-        session_id = resp.cookies["session_id"]
-        return resp, session_id
+        return await self.punchout(
+            "punchout_signup", "GET", url, params=params, cookies=cookies
+        )
 
     async def punchout_signup_post(self, token, post_params, session_id):
         url = self.params.get("url_punchout_signup")
@@ -102,25 +191,28 @@ class OdooAuthHandler:
         cookies = {}
         if session_id:
             cookies["session_id"] = session_id
-        async with httpx.AsyncClient(timeout=20) as client:
-            try:
-                resp = await client.post(url, params=params, data=post_params, cookies=cookies)
-            except (httpx.ConnectError, httpx.TimeoutException):
-                logging.error(traceback.format_exc())
-                return False, False
-            if resp.status_code != 200:
-                logging.info("Authentication failed for punchout signup post")
-                return False, False
-        if not "session_id" in resp.cookies:
-            logging.info("Session cookie not found for punchout signup post")
-            return False, False
-        cookie = resp.cookies["session_id"]
-        return resp, cookie
+        return await self.punchout(
+            "punchout_signup_post",
+            "POST",
+            url,
+            params=params,
+            data=post_params,
+            cookies=cookies,
+        )
 
-    def test(self, url):
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(
-            self.request_odoo(
-                url + "/jsonrpc", {"service": "common", "method": "version", "args": ()}
-            )
+    async def test(self):
+        """Ask Odoo for its version, also while the circuit is open."""
+        resp = await self.request_odoo(
+            self.params.get("url_jsonrpc"),
+            {"service": "common", "method": "version", "args": ()},
+            call="version",
+            probe=True,
         )
+        resp.raise_for_status()
+
+
+metrics.Gauge(
+    "bouncer_odoo_circuit_open",
+    "Odoo instances whose calls are rejected because they keep failing.",
+    lambda: sum(odoo.breaker.state == OPEN for odoo in OdooAuthHandler.instances),
+)
@@ -0,0 +1,382 @@
+#!/bin/env python
+# Copyright 2020 Sunflower IT
+
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from lib import metrics, tracing
+from lib.challenges import CHALLENGE_TTL
+from lib.db import PRAGMAS
+from lib.email import EMAIL_TIMEOUT
+
+
+# Seconds between looking for mails that are due, also those queued by
+# other workers and retries
+POLL_INTERVAL = 1
+# A mail that is not sent or failed this long after a worker took it is
+# taken again, in case that worker died while sending
+CLAIM_SECONDS = 300
+# Longest wait between two attempts
+MAX_BACKOFF = 300
+# Sent, failed and expired mails are kept this long, without their code
+KEEP_SECONDS = 24 * 3600
+# Mails listed by status()
+RECENT = 50
+
+
+class Outbox:
+    """Sends security codes in the background, from a queue in SQLite.
+
+    A login queues its code and answers right away. Every worker takes
+    due mails from the queue, at most `concurrency` at a time, and
+    failed mails are tried again after an exponentially growing wait.
+    A code still waiting for the same address is replaced by the new
+    one, so a user who logs in twice gets one mail, with the code of the
+    page they are looking at. Codes are dropped once they have expired.
+    """
+
+    instances = []
+
+    def __init__(
+        self,
+        database,
+        mailers,
+        concurrency=4,
+        retries=5,
+        backoff=2.0,
+        ttl=CHALLENGE_TTL,
+    ):
+        self.database = database
+        # tenant name -> Email
+        self.mailers = mailers
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.ttl = ttl
+        self.con = None
+        self.con_pid = None
+        self.executor = None
+        self.executor_pid = None
+        # Mails being sent by this process
+        self.sending = set()
+        # Set when there may be mails to send, before the next poll
+        self.wakeup = None
+        # Mails waiting to be sent, as last counted
+        self.queued = 0
+        self.create_tables()
+        Outbox.instances.append(self)
+
+    async def execute(self, func, *args):
+        """Run func on the outbox thread and return its result."""
+
+        if self.executor_pid != os.getpid():
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox")
+            self.executor_pid = os.getpid()
+        loop = asyncio.get_running_loop()
+        start = perf_counter()
+        try:
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            duration = perf_counter() - start
+            query = func.__name__.lstrip("_")
+            metrics.DB_QUERY_DURATION.observe(duration, query)
+            tracing.record("db", query, duration)
+
+    def connect(self):
+        """Connect to the SQLite3 database, once per process."""
+
+        if self.con_pid != os.getpid():
+            self.con = sqlite3.connect(self.database, check_same_thread=False)
+            for pragma in PRAGMAS:
+                self.con.execute(pragma)
+            self.con_pid = os.getpid()
+        return self.con
+
+    def close_before_fork(self):
+        """Close the connection of the parent, workers open their own."""
+
+        if self.con is not None:
+            self.con.close()
+        self.con = None
+        self.con_pid = None
+
+    def create_tables(self):
+        con = self.connect()
+        with con:
+            con.execute(
+                """
+                create table if not exists email_outbox (
+                    id integer primary key,
+                    tenant text not null,
+                    username text not null,
+                    recipient text not null,
+                    code text,
+                    status text not null default 'pending',
+                    attempts integer not null default 0,
+                    next_attempt integer not null,
+                    created real not null,
+                    updated integer not null,
+                    error text
+                )
+            """
+            )
+            # One waiting mail per address, see _queue()
+            con.execute(
+                """
+                create unique index if not exists email_outbox_waiting
+                on email_outbox (tenant, recipient) where status = 'pending'
+            """
+            )
+            con.execute(
+                """
+                create index if not exists email_outbox_due
+                on email_outbox (status, next_attempt)
+            """
+            )
+
+    async def queue(self, tenant, username, code):
+        """Queue the code for username, False when it has no valid address."""
+
+        recipient = self.mailers[tenant].recipients(username)
+        if not recipient:
+            return False
+        replaced = await self.execute(
+            self._queue, tenant, username, recipient, code, time.time()
+        )
+        if replaced:
+            metrics.OUTBOX_MAILS.inc("replaced")
+        if self.wakeup:
+            self.wakeup.set()
+        return True
+
+    def _queue(self, tenant, username, recipient, code, now):
+        # A mail that is being sent is left alone: its code may already be
+        # with the SMTP server, and marking it replaced would not stop it.
+        # The new code is queued next to it, and if the old one fails, it
+        # is not tried again, see _retry().
+        con = self.connect()
+        with con:
+            con.execute("begin immediate")
+            cur = con.execute(
+                """
+                update email_outbox
+                set username = ?, code = ?, attempts = 0, next_attempt = ?, error = null,
+                created = ?, updated = ?
+                where tenant = ? and recipient = ? and status = 'pending'
+            """,
+                (username, code, int(now), now, int(now), tenant, recipient),
+            )
+            # The new code gets all attempts, starting now
+            if cur.rowcount:
+                return True
+            con.execute(
+                """
+                insert into email_outbox
+                (tenant, username, recipient, code, next_attempt, created, updated)
+                values (?, ?, ?, ?, ?, ?, ?)
+            """,
+                (tenant, username, recipient, code, int(now), now, int(now)),
+            )
+            return False
+
+    async def run(self):
+        """Send queued mails, for as long as the server runs."""
+
+        self.wakeup = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.send_due()
+            except Exception:
+                logging.exception("Taking mails from the outbox failed")
+
+    async def send_due(self):
+        """Start sending due mails, as many as there is room for."""
+
+        limit = self.concurrency - len(self.sending)
+        mails, self.queued = await self.execute(self._claim, limit, int(time.time()))
+        for mail in mails:
+            task = asyncio.ensure_future(self.deliver(*mail))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+
+    def _claim(self, limit, now):
+        con = self.connect()
+        with con:
+            con.execute("begin immediate")
+            mails = con.execute(
+                """
+                select id, tenant, username, code, attempts, created
+                from email_outbox
+                where status in ('pending', 'sending') and next_attempt <= ?
+                order by next_attempt limit ?
+            """,
+                (now, limit),
+            ).fetchall()
+            con.executemany(
+                """
+                update email_outbox set status = 'sending', next_attempt = ?, updated = ?
+                where id = ?
+            """,
+                [(now + CLAIM_SECONDS, now, mail[0]) for mail in mails],
+            )
+            (queued,) = con.execute(
+                """
+                select count(*) from email_outbox where status in ('pending', 'sending')
+            """
+            ).fetchone()
+        return mails, queued
+
+    async def deliver(self, id, tenant, username, code, attempts, created):
+        """Send one mail, and record how that went."""
+
+        try:
+            now = time.time()
+            email = self.mailers.get(tenant)
+            if created + self.ttl <= now:
+                await self.execute(self._finish, id, "expired", attempts, None)
+                metrics.OUTBOX_MAILS.inc("expired")
+                logging.warning("Security code for %s expired in the outbox", username)
+                return
+            if email is None:
+                error = "No tenant {}".format(tenant)
+            else:
+                try:
+                    # Retried by the outbox, after a wait
+                    if await email.send(username, code, retries=1):
+                        await self.execute(self._finish, id, "sent", attempts + 1, None)
+                        metrics.OUTBOX_MAILS.inc("sent")
+                        metrics.OUTBOX_DELAY.observe(time.time() - created)
+                        return
+                    error = "SMTP failed"
+                except Exception as e:
+                    error = repr(e)
+            attempts += 1
+            retry_at = time.time() + min(
+                MAX_BACKOFF, self.backoff * 2 ** (attempts - 1)
+            ) * random.uniform(1, 1.25)
+            if email is None or attempts >= self.retries or retry_at >= created + self.ttl:
+                status = await self.execute(self._finish, id, "failed", attempts, error)
+                logging.error(
+                    "Security code for %s not sent after %d attempts: %s",
+                    username,
+                    attempts,
+                    error,
+                )
+            else:
+                status = await self.execute(
+                    self._retry, id, attempts, int(retry_at), error
+                )
+                logging.warning(
+                    "Security code for %s not sent, trying again in %d seconds: %s",
+                    username,
+                    retry_at - time.time(),
+                    error,
+                )
+            metrics.OUTBOX_MAILS.inc(status)
+        except Exception:
+            logging.exception("Sending security code for %s failed", username)
+        finally:
+            # There is room for another mail
+            self.wakeup.set()
+
+    def _finish(self, id, status, attempts, error):
+        con = self.connect()
+        with con:
+            con.execute(
+                """
+                update email_outbox
+                set status = ?, attempts = ?, error = ?, code = null, updated = ?
+                where id = ?
+            """,
+                (status, attempts, error, int(time.time()), id),
+            )
+        return status
+
+    def _retry(self, id, attempts, next_attempt, error):
+        con = self.connect()
+        try:
+            with con:
+                con.execute(
+                    """
+                    update email_outbox
+                    set status = 'pending', attempts = ?, next_attempt = ?, error = ?,
+                    updated = ?
+                    where id = ?
+                """,
+                    (attempts, next_attempt, error, int(time.time()), id),
+                )
+        except sqlite3.IntegrityError:
+            # A newer code for the same address was queued meanwhile
+            return self._finish(id, "replaced", attempts, error)
+        return "retried"
+
+    async def status(self):
+        """Mails by status, and the most recent ones, for operators."""
+        return await self.execute(self._status)
+
+    def _status(self):
+        con = self.connect()
+        counts = dict(
+            con.execute("select status, count(*) from email_outbox group by status")
+        )
+        recent = [
+            dict(
+                zip(
+                    (
+                        "id",
+                        "tenant",
+                        "recipient",
+                        "status",
+                        "attempts",
+                        "error",
+                        "created",
+                        "updated",
+                    ),
+                    row,
+                )
+            )
+            for row in con.execute(
+                """
+                select id, tenant, recipient, status, attempts, error, created, updated
+                from email_outbox order by updated desc, id desc limit ?
+            """,
+                (RECENT,),
+            )
+        ]
+        return {"counts": counts, "recent": recent}
+
+    async def cleanup(self):
+        await self.execute(self._cleanup, int(time.time()))
+
+    def _cleanup(self, now):
+        con = self.connect()
+        with con:
+            con.execute(
+                "delete from email_outbox where updated < ? and status not in "
+                "('pending', 'sending')",
+                (now - KEEP_SECONDS,),
+            )
+
+    async def close(self):
+        """Give the mails being sent a chance to finish."""
+        if self.sending:
+            await asyncio.wait(self.sending, timeout=EMAIL_TIMEOUT)
+
+
+metrics.Gauge(
+    "bouncer_outbox_queued",
+    "Security codes waiting in the outbox, as last counted by this worker.",
+    lambda: sum(outbox.queued for outbox in Outbox.instances),
+)
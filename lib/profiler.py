@@ -0,0 +1,73 @@
+#!/bin/env python
+# Copyright 2020 Sunflower IT
+
+"""Short profiles of a running worker, served on the metrics port.
+
+Both run while the worker keeps serving requests, and only see the
+thread of its event loop: time spent in the database thread shows up
+as waiting.
+"""
+
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import tracemalloc
+
+
+# Longest profile that may be asked for, in seconds
+MAX_SECONDS = 60
+SORT_KEYS = tuple(key.value for key in pstats.SortKey)
+
+
+class ProfilerBusy(Exception):
+    """Another profile of this worker is still running."""
+
+
+busy = False
+
+
+async def profile(seconds, sort="cumulative", limit=50):
+    """Profile the event loop for seconds, return the pstats report."""
+    global busy
+    if busy:
+        raise ProfilerBusy()
+    busy = True
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+    finally:
+        busy = False
+    out = io.StringIO()
+    out.write("Profile of worker {}, {} seconds\n".format(os.getpid(), seconds))
+    pstats.Stats(profiler, stream=out).sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+
+async def allocations(seconds, limit=50):
+    """Memory allocated and not freed during seconds, by line, most first."""
+    global busy
+    if busy:
+        raise ProfilerBusy()
+    busy = True
+    started = not tracemalloc.is_tracing()
+    try:
+        if started:
+            tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        await asyncio.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+    finally:
+        if started:
+            tracemalloc.stop()
+        busy = False
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    stats = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), "lineno")
+    lines = ["Allocations of worker {}, {} seconds".format(os.getpid(), seconds)]
+    lines.extend(str(stat) for stat in stats[:limit])
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,311 @@
+#!/bin/env python
+# Copyright 2020 Sunflower IT
+
+import asyncio
+import hmac
+import json
+import os
+import ssl
+
+from time import perf_counter, time
+from urllib.parse import unquote, urlparse
+
+from lib import metrics, tracing
+from lib.challenges import CHALLENGE_TTL, MAX_CODE_FAILURES, random_code
+from lib.sessionstore import SessionStore
+
+
+# Session changes kept for other bouncers, who read them every few seconds
+EVENTS_MAX = 10000
+EVENTS_BATCH_SIZE = 1000
+
+
+class RedisError(Exception):
+    """An error reply of the server."""
+
+
+# Error replies of a server that is starting, busy or failing over
+TRANSIENT_REPLIES = ("LOADING", "BUSY", "TRYAGAIN", "READONLY", "MASTERDOWN")
+
+
+class RedisClient:
+    """A minimal client of the Redis protocol (RESP2), over asyncio streams.
+
+    Takes a URL like redis://:password@host:6379/0, or rediss:// for TLS.
+    One connection per process, opened on first use; commands are sent
+    one pipeline at a time. A pipeline that takes longer than `timeout`
+    seconds, connecting included, fails.
+    """
+
+    def __init__(self, url, timeout=5):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.ssl = ssl.create_default_context() if parsed.scheme == "rediss" else None
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.database = int(parsed.path.strip("/") or 0)
+        self.timeout = timeout
+        self.reader = self.writer = None
+        self.pid = None
+        self.lock = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, ssl=self.ssl
+        )
+        commands = []
+        if self.password:
+            if self.username:
+                commands.append(("AUTH", self.username, self.password))
+            else:
+                commands.append(("AUTH", self.password))
+        if self.database:
+            commands.append(("SELECT", self.database))
+        for reply in await self._send(commands):
+            if isinstance(reply, RedisError):
+                self.close()
+                raise reply
+
+    async def execute(self, *command):
+        (reply,) = await self.pipeline([command])
+        if isinstance(reply, RedisError):
+            raise reply
+        return reply
+
+    async def pipeline(self, commands):
+        """Send commands at once, return their replies; errors are returned."""
+
+        # A forked worker must not share the connection of its parent
+        if self.pid != os.getpid():
+            self.reader = self.writer = None
+            self.lock = asyncio.Lock()
+            self.pid = os.getpid()
+        start = perf_counter()
+        async with self.lock:
+            try:
+                return await asyncio.wait_for(self._exchange(commands), self.timeout)
+            except BaseException:
+                # Replies may be left unread, and would be taken for those
+                # of the next commands: reconnect on the next call
+                self.close()
+                raise
+            finally:
+                duration = perf_counter() - start
+                query = commands[0][0].lower()
+                metrics.DB_QUERY_DURATION.observe(duration, query)
+                tracing.record("redis", query, duration)
+
+    async def _exchange(self, commands):
+        if self.writer is None:
+            await self.connect()
+        return await self._send(commands)
+
+    async def _send(self, commands):
+        self.writer.write(b"".join(self.encode(command) for command in commands))
+        await self.writer.drain()
+        return [await self.read_reply() for _ in commands]
+
+    @staticmethod
+    def encode(command):
+        parts = [arg if isinstance(arg, bytes) else str(arg).encode() for arg in command]
+        return b"*%d\r\n" % len(parts) + b"".join(
+            b"$%d\r\n%s\r\n" % (len(part), part) for part in parts
+        )
+
+    async def read_reply(self):
+        line = await self.reader.readuntil(b"\r\n")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            return RedisError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = await self.reader.readexactly(length + 2)
+            return data[:-2].decode()
+        if kind == b"*":
+            length = int(rest)
+            if length < 0:
+                return None
+            return [await self.read_reply() for _ in range(length)]
+        raise RedisError("Unexpected reply: {!r}".format(line))
+
+    def close(self):
+        if self.writer is not None and self.pid == os.getpid():
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class RedisStore(SessionStore):
+    """Keeps sessions and security codes in a server speaking the Redis
+    protocol, shared by the bouncers of several hosts.
+
+    Sessions are keys that expire along with the session. Every change is
+    also added to a stream, from which the other bouncers update their
+    cache. A session unknown to the cache is always looked up.
+    """
+
+    def __init__(self, url, prefix="bouncer:", timeout=5):
+        super().__init__()
+        self.client = RedisClient(url, timeout)
+        self.prefix = prefix
+        self.events_key = prefix + "session_events"
+        # Sorted set of logouts, scored by the time they are remembered until
+        self.removals_key = prefix + "session_removals"
+        self.lookup_on_miss = True
+        # Id of the last event read from the stream, None before the first
+        self.last_event_id = None
+
+    def is_transient(self, error):
+        if isinstance(error, RedisError):
+            return str(error).startswith(TRANSIENT_REPLIES)
+        return super().is_transient(error)
+
+    def session_key(self, session):
+        return self.prefix + "session:" + session
+
+    def hotp_key(self, counter):
+        return self.prefix + "hotp:" + str(counter)
+
+    async def fetch_session(self, session):
+        expiry = await self.client.execute("GET", self.session_key(session))
+        return int(expiry) if expiry else None
+
+    async def store_sessions(self, writes):
+        commands = [("MULTI",)]
+        for session, expiry in writes:
+            key = self.session_key(session)
+            if expiry is None:
+                commands.append(("DEL", key))
+            else:
+                commands.append(("SET", key, expiry))
+                commands.append(("EXPIREAT", key, expiry))
+            commands.append(
+                (
+                    "XADD", self.events_key, "MAXLEN", "~", EVENTS_MAX, "*",
+                    "session", session, "expiry", "" if expiry is None else expiry,
+                )
+            )
+            if expiry is None and self.keep_removals:
+                commands.append(
+                    ("ZADD", self.removals_key, int(time() + self.keep_removals), session)
+                )
+        commands.append(("EXEC",))
+        *_queued, executed = await self.client.pipeline(commands)
+        # A command that cannot be queued aborts the transaction
+        if isinstance(executed, RedisError):
+            raise executed
+        for reply in executed or []:
+            if isinstance(reply, RedisError):
+                raise reply
+
+    async def store_touches(self, touches):
+        commands = []
+        for session, expiry in touches:
+            key = self.session_key(session)
+            # XX: never brings back a removed session
+            commands.append(("SET", key, expiry, "XX"))
+            commands.append(("EXPIREAT", key, expiry))
+        for reply in await self.client.pipeline(commands):
+            if isinstance(reply, RedisError):
+                raise reply
+
+    async def fetch_removals(self):
+        reply = await self.client.execute(
+            "ZRANGEBYSCORE", self.removals_key, int(time()), "+inf", "WITHSCORES"
+        )
+        reply = reply or []
+        return [(reply[i], int(float(reply[i + 1]))) for i in range(0, len(reply), 2)]
+
+    async def cleanup(self):
+        await super().cleanup()
+        if self.keep_removals:
+            await self.client.execute(
+                "ZREMRANGEBYSCORE", self.removals_key, "-inf", int(time())
+            )
+
+    async def fetch_events(self):
+        if self.last_event_id is None:
+            # Sessions written before are looked up when they are used
+            last = await self.client.execute(
+                "XREVRANGE", self.events_key, "+", "-", "COUNT", 1
+            )
+            self.last_event_id = last[0][0] if last else "0-0"
+            return []
+        reply = await self.client.execute(
+            "XREAD", "COUNT", EVENTS_BATCH_SIZE, "STREAMS",
+            self.events_key, self.last_event_id,
+        )
+        events = []
+        for _key, entries in reply or []:
+            for event_id, fields in entries:
+                self.last_event_id = event_id
+                values = dict(zip(fields[::2], fields[1::2]))
+                expiry = values.get("expiry")
+                events.append((values.get("session"), int(expiry) if expiry else None))
+        return events
+
+    async def next_hotp_id(self, session_id, payload=None, username=None):
+        """Issue a security code for a session, see DB.next_hotp_id."""
+
+        counter = await self.client.execute("INCR", self.prefix + "hotp_counter")
+        code = random_code()
+        await self.client.execute(
+            "SET", self.hotp_key(counter), json.dumps([code, session_id, payload, username]),
+            "EX", CHALLENGE_TTL,
+        )
+        return counter, code
+
+    async def reserve_hotp_ids(self, count):
+        last = await self.client.execute("INCRBY", self.prefix + "hotp_counter", count)
+        return last - count + 1
+
+    async def verify_code_and_expiry(self, counter, code):
+        """Return the session, payload and username of a code, see DB."""
+
+        try:
+            key = self.hotp_key(int(counter))
+        except (TypeError, ValueError):
+            return False, None, None
+        challenge = await self.client.execute("GET", key)
+        if challenge is None:
+            return False, None, None
+        expected, session_id, payload, username = json.loads(challenge)
+        if not hmac.compare_digest(expected, str(code)):
+            return False, None, None
+        # Only the first of two bouncers verifying the same code wins
+        if not await self.client.execute("DEL", key):
+            return False, None, None
+        return session_id, payload, username
+
+    async def fail_code(self, counter, code):
+        """Count a wrong security code, see DB.fail_code."""
+
+        try:
+            key = self.hotp_key(int(counter))
+        except (TypeError, ValueError):
+            return None
+        challenge = await self.client.execute("GET", key)
+        if challenge is None:
+            return None
+        expected, session_id, payload, username = json.loads(challenge)
+        if not hmac.compare_digest(expected, str(code)):
+            return None
+        # Counted by all bouncers together
+        failures_key = key + ":failures"
+        failures = await self.client.execute("INCR", failures_key)
+        if failures == 1:
+            await self.client.execute(
+                "EXPIREAT", failures_key, int(time() + CHALLENGE_TTL)
+            )
+        if failures >= MAX_CODE_FAILURES:
+            await self.client.execute("DEL", key, failures_key)
+        return username
+
+    async def close(self):
+        self.client.close()
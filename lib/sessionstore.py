@@ -0,0 +1,316 @@
+#!/bin/env python
+# Copyright 2020 Sunflower IT
+
+import asyncio
+import heapq
+import logging
+import sqlite3
+
+from time import time
+
+from lib import metrics
+from lib.challenges import MemoryChallenges
+
+
+class SessionStore:
+    """Sessions cached in memory, in front of a backend that keeps them.
+
+    The cache answers most session checks without a call to the backend.
+    Backends implement fetch_session, store_sessions, store_touches and
+    fetch_events, and keep the pending security codes: next_hotp_id,
+    verify_code_and_expiry, fail_code and reserve_hotp_ids.
+    """
+
+    # Every store of this process, for the cache size metric
+    instances = []
+    # Errors after which a write may succeed when tried again: the backend
+    # could not be reached, timed out or was locked
+    transient_errors = (
+        OSError,
+        EOFError,
+        asyncio.TimeoutError,
+        sqlite3.OperationalError,
+    )
+
+    def is_transient(self, error):
+        return isinstance(error, self.transient_errors)
+
+    def __init__(self):
+        # Expiry of each session, in seconds since the epoch
+        self.session_cache = {}
+        # Min-heap of (expiry, session), to evict sessions in order of expiry.
+        # Entries of sessions that were removed or saved again are skipped.
+        self.session_expiry = []
+        # When several processes share the backend, a session unknown to
+        # this one may just have been created by another one.
+        self.lookup_on_miss = False
+        # Called with the session id of every logout, also of other workers
+        self.removal_listeners = []
+        # Seconds that logouts are remembered by the backend, so the signed
+        # tokens of their sessions stay revoked after a restart
+        self.keep_removals = 0
+        # Session changes are gathered for this many seconds, then written
+        # at once; 0 writes every change right away.
+        self.write_delay = 0
+        self.write_batch_size = 100
+        # Whether a login waits until its session is written. Other workers
+        # only see a session once it is written.
+        self.wait_for_writes = False
+        # session -> expiry in seconds since the epoch, or None to remove
+        self.pending_writes = {}
+        # Resolved when the pending writes are written
+        self.written = None
+        # With a sliding lifetime in seconds, a session in use is extended
+        # to that long after its last use. Extensions are written every
+        # touch_interval seconds, at most once per session.
+        self.sliding_lifetime = 0
+        self.touch_interval = 60
+        # session -> extended expiry, not written yet
+        self.touched = {}
+        self.interval_lengths = {}
+        self.instances.append(self)
+
+    async def fetch_session(self, session):
+        """Expiry of a session in the backend, None when unknown."""
+        raise NotImplementedError
+
+    async def store_sessions(self, writes):
+        """Write (session, expiry) pairs, an expiry of None removes."""
+        raise NotImplementedError
+
+    async def store_touches(self, touches):
+        """Extend (session, expiry) pairs, of sessions that still exist."""
+        raise NotImplementedError
+
+    async def fetch_events(self):
+        """(session, expiry) changes written since the last call."""
+        raise NotImplementedError
+
+    async def fetch_removals(self):
+        """(session, remembered until) of the logouts still remembered."""
+        raise NotImplementedError
+
+    async def remove_session(self, session):
+        if not session:
+            return
+        self.session_cache.pop(session, None)
+        self.touched.pop(session, None)
+        for listener in self.removal_listeners:
+            listener(session)
+        # A logout lost in a crash would revive the session, always wait
+        await self.queue_write(session, None, wait=True)
+
+    def check_session(self, session):
+        """Check a session against the cache only.
+
+        Returns None when the session is not cached, but may have been
+        created by another worker and has to be looked up.
+        """
+
+        expiry = self.session_cache.get(session)
+        if expiry is None:
+            if session and self.lookup_on_miss:
+                return None
+            return False
+        now = time()
+        if expiry < now:
+            # Another worker may have extended it since
+            if self.sliding_lifetime and self.lookup_on_miss:
+                return None
+            return False
+        if self.sliding_lifetime:
+            self.touch(session, expiry, now)
+        return True
+
+    async def verify_session(self, session):
+        valid = self.check_session(session)
+        if valid is None:
+            expiry = await self.load_session(session)
+            now = time()
+            valid = expiry is not None and expiry >= now
+            if valid and self.sliding_lifetime:
+                self.touch(session, expiry, now)
+        return valid
+
+    def touch(self, session, expiry, now):
+        """Extend a session in use, in memory until the next flush_touches."""
+
+        extended = int(now) + self.sliding_lifetime
+        if extended - expiry >= self.touch_interval:
+            self.cache_session(session, extended)
+            self.touched[session] = extended
+
+    async def flush_touches(self):
+        """Write the extended expiries in one go."""
+
+        if not self.touched:
+            return
+        touches, self.touched = self.touched, {}
+        try:
+            await self.store_touches(list(touches.items()))
+        except Exception:
+            for session, expiry in touches.items():
+                self.touched.setdefault(session, expiry)
+            raise
+
+    async def load_session(self, session):
+        expiry = await self.fetch_session(session)
+        if not expiry:
+            return None
+        self.cache_session(session, expiry)
+        return expiry
+
+    def interval_seconds(self, interval):
+        """Length of an SQLite date modifier like '+16 hours', in seconds."""
+
+        if interval not in self.interval_lengths:
+            con = sqlite3.connect(":memory:")
+            try:
+                (length,) = con.execute(
+                    "select strftime('%s', 'now', ?) - strftime('%s', 'now')",
+                    (interval,),
+                ).fetchone()
+            finally:
+                con.close()
+            self.interval_lengths[interval] = length
+        return self.interval_lengths[interval]
+
+    async def sync_sessions(self):
+        """Apply session changes made by other processes."""
+
+        for session, expiry in await self.fetch_events():
+            if expiry is None:
+                self.session_cache.pop(session, None)
+                for listener in self.removal_listeners:
+                    listener(session)
+            else:
+                self.cache_session(session, expiry)
+
+    def cache_session(self, session, expiry):
+        self.session_cache[session] = expiry
+        heapq.heappush(self.session_expiry, (expiry, session))
+
+    def evict_expired(self):
+        """Drop expired sessions from the cache."""
+
+        now = time()
+        heap = self.session_expiry
+        while heap and heap[0][0] < now:
+            expiry, session = heapq.heappop(heap)
+            cached_expiry = self.session_cache.get(session)
+            if cached_expiry is not None and cached_expiry < now:
+                del self.session_cache[session]
+        # Don't let entries of logged out sessions pile up
+        if len(heap) > 2 * len(self.session_cache) + 100:
+            heap[:] = [
+                (expiry, session) for session, expiry in self.session_cache.items()
+            ]
+            heapq.heapify(heap)
+
+    async def save_session(self, session, interval):
+        """Save a session, return its expiry in seconds since the epoch.
+
+        The session is valid in this process right away. Unless
+        wait_for_writes is set, it is written with the next batch, and a
+        crash before that loses it: the user then has to log in again.
+        """
+
+        expiry = int(time()) + self.interval_seconds(interval)
+        self.cache_session(session, expiry)
+        await self.queue_write(session, expiry, wait=self.wait_for_writes)
+        return expiry
+
+    async def queue_write(self, session, expiry, wait=False):
+        self.pending_writes[session] = expiry
+        if not self.write_delay or len(self.pending_writes) >= self.write_batch_size:
+            await self.flush_writes()
+        elif wait:
+            if self.written is None:
+                self.written = asyncio.get_running_loop().create_future()
+            await asyncio.shield(self.written)
+
+    async def flush_writes(self):
+        """Write the pending session changes at once."""
+
+        if not self.pending_writes:
+            return
+        writes, self.pending_writes = self.pending_writes, {}
+        written, self.written = self.written, None
+        try:
+            await self.store_sessions(list(writes.items()))
+        except Exception as e:
+            if self.is_transient(e):
+                # Keep them for the next flush, unless changed again meanwhile
+                for session, expiry in writes.items():
+                    self.pending_writes.setdefault(session, expiry)
+            else:
+                # Would fail again, and hold up all later writes
+                logging.error("Dropped %d session changes: %r", len(writes), e)
+            if written:
+                written.set_exception(e)
+            raise
+        if written:
+            written.set_result(None)
+
+    async def cleanup(self):
+        self.evict_expired()
+
+    async def close(self):
+        pass
+
+    def close_before_fork(self):
+        """Let go of connections that forked workers must not share."""
+        pass
+
+
+class MemoryStore(SessionStore):
+    """Keeps sessions and security codes in this process only.
+
+    Nothing survives a restart, and other processes cannot see the
+    sessions, so it is meant for tests and benchmarks with one worker.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.last_hotp_id = 0
+        self.challenges = MemoryChallenges(self)
+
+    async def fetch_session(self, session):
+        return None
+
+    async def store_sessions(self, writes):
+        pass
+
+    async def store_touches(self, touches):
+        pass
+
+    async def fetch_events(self):
+        return []
+
+    async def fetch_removals(self):
+        return []
+
+    async def next_hotp_id(self, session_id, payload=None, username=None):
+        return await self.challenges.next_hotp_id(session_id, payload, username)
+
+    async def reserve_hotp_ids(self, count):
+        first = self.last_hotp_id + 1
+        self.last_hotp_id += count
+        return first
+
+    async def verify_code_and_expiry(self, counter, code):
+        return await self.challenges.verify_code_and_expiry(counter, code)
+
+    async def fail_code(self, counter, code):
+        return await self.challenges.fail_code(counter, code)
+
+    async def cleanup(self):
+        await super().cleanup()
+        await self.challenges.prune()
+
+
+metrics.Gauge(
+    "bouncer_session_cache_size",
+    "Sessions held in memory.",
+    lambda: sum(len(store.session_cache) for store in SessionStore.instances),
+)
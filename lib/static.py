@@ -0,0 +1,56 @@
+#!/bin/env python
+# Copyright 2020 Sunflower IT
+
+import mimetypes
+import os
+
+from tornado.web import StaticFileHandler
+
+
+# Variants written by compress-static.py, the preferred one first
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def static_href(handler, path):
+    """Versioned URL of a static file, relative because NGINX serves the
+    bouncer below /nginx-odoo-login/."""
+    return handler.static_url(path).lstrip("/")
+
+
+class PrecompressedStaticFileHandler(StaticFileHandler):
+    """Serves a precompressed variant of a file to clients that accept it.
+
+    Versioned URLs are cached by browsers for a long time; the others are
+    checked with their ETag.
+    """
+
+    encoding = None
+
+    def validate_absolute_path(self, root, absolute_path):
+        absolute_path = super().validate_absolute_path(root, absolute_path)
+        if absolute_path is None:
+            return None
+        accepted = self.request.headers.get("Accept-Encoding", "")
+        for encoding, suffix in ENCODINGS:
+            if encoding not in accepted:
+                continue
+            try:
+                compressed = os.stat(absolute_path + suffix)
+            except OSError:
+                continue
+            if compressed.st_mtime >= os.stat(absolute_path).st_mtime:
+                self.encoding = encoding
+                # Size and modification time of the variant that is sent
+                self._stat_result = compressed
+                return absolute_path + suffix
+        return absolute_path
+
+    def set_extra_headers(self, path):
+        self.set_header("Vary", "Accept-Encoding")
+        if self.encoding:
+            self.set_header("Content-Encoding", self.encoding)
+
+    def get_content_type(self):
+        # Of the original file, not of its compressed variant
+        mime_type, encoding = mimetypes.guess_type(self.path)
+        return mime_type or "application/octet-stream"
@@ -0,0 +1,75 @@
+#!/bin/env python
+# Copyright 2020 Sunflower IT
+
+
+class Tenant:
+    """One Odoo instance served by the bouncer.
+
+    Has its own Odoo connection pool, SMTP pool, branding and session
+    store, so the sessions and security codes of one instance are never
+    valid at another.
+    """
+
+    def __init__(
+        self,
+        name,
+        hosts,
+        db,
+        challenges,
+        odoo,
+        email,
+        theme_params,
+        hotp_secret,
+        expiry_interval,
+        disable_email=False,
+        signer=None,
+    ):
+        self.name = name
+        self.hosts = hosts
+        self.db = db
+        self.challenges = challenges
+        self.odoo = odoo
+        self.email = email
+        self.theme_params = theme_params
+        self.hotp_secret = hotp_secret
+        self.expiry_interval = expiry_interval
+        self.disable_email = disable_email
+        self.signer = signer
+
+
+def host_name(host):
+    """The lower case name of a Host header, without the port."""
+    host = (host or "").strip().lower()
+    if host.startswith("["):
+        return host.partition("]")[0] + "]"
+    return host.partition(":")[0]
+
+
+class Tenants:
+    """The tenants of the bouncer, found by the Host header of a request.
+
+    Requests for a host that no tenant claims go to the default tenant,
+    configured in .env.
+    """
+
+    def __init__(self, default):
+        self.default = default
+        self.all = []
+        self.by_host = {}
+        self.add(default)
+
+    def add(self, tenant):
+        for host in tenant.hosts:
+            other = self.by_host.get(host_name(host))
+            if other:
+                raise ValueError(
+                    "Host {} is claimed by {} and {}".format(host, other.name, tenant.name)
+                )
+            self.by_host[host_name(host)] = tenant
+        self.all.append(tenant)
+
+    def for_host(self, host):
+        return self.by_host.get(host_name(host), self.default)
+
+    def __iter__(self):
+        return iter(self.all)
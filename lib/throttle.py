@@ -0,0 +1,136 @@
+#!/bin/env python
+# Copyright 2020 Sunflower IT
+
+import ipaddress
+import logging
+import time
+
+
+class SlidingWindow:
+    """Counts events per key over the last `window` seconds.
+
+    Keeps two counters per key, for the current and the previous fixed
+    window, and weighs the previous one by how much of it still falls in
+    the sliding window. Memory per key stays constant however many
+    events come in.
+    """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        # key -> [number of current window, previous count, current count]
+        self.counters = {}
+
+    def roll(self, entry, now):
+        number = int(now // self.window)
+        if entry[0] != number:
+            entry[1] = entry[2] if number - entry[0] == 1 else 0
+            entry[2] = 0
+            entry[0] = number
+        return entry
+
+    def count(self, key):
+        entry = self.counters.get(key)
+        if not entry:
+            return 0
+        now = time.monotonic()
+        number, previous, current = self.roll(entry, now)
+        elapsed = now / self.window - number
+        return previous * (1 - elapsed) + current
+
+    def blocked(self, key):
+        return bool(self.limit) and self.count(key) >= self.limit
+
+    def add(self, key):
+        now = time.monotonic()
+        entry = self.counters.get(key)
+        if entry is None:
+            entry = self.counters[key] = [int(now // self.window), 0, 0]
+        self.roll(entry, now)[2] += 1
+
+    def reset(self, key):
+        self.counters.pop(key, None)
+
+    def prune(self):
+        """Forget keys without events in the last two windows."""
+        now = time.monotonic()
+        self.counters = {
+            key: entry
+            for key, entry in self.counters.items()
+            if any(self.roll(entry, now)[1:])
+        }
+
+
+class LoginThrottle:
+    """Rejects logins after too many failures from one IP or for one user.
+
+    Checked before Odoo is asked, so an attacker cannot keep Odoo busy
+    hashing passwords. Behind NGINX without trusted proxy headers, every
+    client seems to come from a loopback address; those are then only
+    limited per username, not all together.
+    """
+
+    def __init__(self, ip_limit, user_limit, window, trust_loopback=False):
+        self.by_ip = SlidingWindow(ip_limit, window)
+        self.by_user = SlidingWindow(user_limit, window)
+        self.trust_loopback = trust_loopback
+
+    def ip_key(self, ip):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        # Clients on a Unix socket all seem to come from 0.0.0.0
+        if address.is_unspecified:
+            return None
+        if address.is_loopback and not self.trust_loopback:
+            return None
+        return ip
+
+    def blocked(self, ip, username=None):
+        ip = self.ip_key(ip)
+        if ip and self.by_ip.blocked(ip):
+            return True
+        return bool(username) and self.by_user.blocked(username.lower())
+
+    def failed(self, ip, username=None):
+        ip = self.ip_key(ip)
+        if ip:
+            self.by_ip.add(ip)
+        if username:
+            self.by_user.add(username.lower())
+
+    def succeeded(self, username):
+        self.by_user.reset(username.lower())
+
+    async def prune(self):
+        self.by_ip.prune()
+        self.by_user.prune()
+
+
+class FailureLog:
+    """Logs failures as one summary per interval, instead of a line each."""
+
+    samples_kept = 3
+
+    def __init__(self, message):
+        self.message = message
+        self.count = 0
+        self.samples = []
+
+    def record(self, sample):
+        self.count += 1
+        if len(self.samples) < self.samples_kept:
+            self.samples.append(sample)
+
+    async def flush(self):
+        if not self.count:
+            return
+        logging.warning(
+            "%s: %d times, for example: %s",
+            self.message,
+            self.count,
+            ", ".join(str(sample) for sample in self.samples),
+        )
+        self.count = 0
+        self.samples = []
@@ -0,0 +1,87 @@
+#!/bin/env python
+# Copyright 2020 Sunflower IT
+
+import base64
+import hashlib
+import hmac
+import time
+
+
+class TokenSigner:
+    """Signs and checks tokens that carry an Odoo session id, its expiry and
+    the tenant it was issued for.
+
+    A token is checked with an HMAC only, so any worker or bouncer with
+    the same secret can verify it without a session store. Logged out
+    sessions are remembered in a small revocation set until they would
+    have expired anyway.
+    """
+
+    cookie_name = "bouncer_token"
+
+    def __init__(self, secret, max_age, tenant="default"):
+        self.key = hashlib.sha256(secret.encode()).digest()
+        self.max_age = max_age
+        # A token of one tenant is never valid at another, also when they
+        # share the secret
+        self.tenant = tenant
+        # session id -> time after which it no longer needs to be revoked
+        self.revoked = {}
+
+    def mac(self, payload):
+        return base64.urlsafe_b64encode(
+            hmac.new(self.key, payload, hashlib.sha256).digest()[:18]
+        )
+
+    def sign(self, session, expiry):
+        payload = "{}|{}|{}".format(session, int(expiry), self.tenant).encode()
+        # Without padding, so the cookie value never needs quoting
+        encoded = base64.urlsafe_b64encode(payload).rstrip(b"=")
+        return (encoded + b"." + self.mac(payload)).decode()
+
+    def decode(self, token):
+        """Return (session, expiry) of a correctly signed token of this
+        tenant, or None."""
+        if not token:
+            return None
+        encoded, sep, mac = token.encode().partition(b".")
+        try:
+            payload = base64.urlsafe_b64decode(encoded + b"=" * (-len(encoded) % 4))
+        except ValueError:
+            return None
+        if not sep or not hmac.compare_digest(mac, self.mac(payload)):
+            return None
+        try:
+            session, expiry, tenant = payload.decode().rsplit("|", 2)
+        except ValueError:
+            return None
+        if tenant != self.tenant:
+            return None
+        return session, int(expiry)
+
+    def valid_until(self, token, session):
+        """Expiry of a valid token for the session_id cookie, or None."""
+        decoded = self.decode(token)
+        if decoded is None:
+            return None
+        token_session, expiry = decoded
+        if (
+            token_session != session
+            or expiry < time.time()
+            or token_session in self.revoked
+        ):
+            return None
+        return expiry
+
+    def verify(self, token, session):
+        """Check a token, and that it belongs to the session_id cookie."""
+        return self.valid_until(token, session) is not None
+
+    def revoke(self, session, expiry=None):
+        self.revoked[session] = expiry or time.time() + self.max_age
+
+    async def prune(self):
+        now = time.time()
+        self.revoked = {
+            session: expiry for session, expiry in self.revoked.items() if expiry >= now
+        }
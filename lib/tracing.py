@@ -0,0 +1,64 @@
+#!/bin/env python
+# Copyright 2020 Sunflower IT
+
+"""Timings of the stages of a request, for a Server-Timing header.
+
+A sampled request gets a Trace in a context variable. The calls to Odoo,
+the SMTP server and the session store, and template rendering, add
+their duration to it with record(); for other requests that is a single
+lookup.
+"""
+
+import logging
+import random
+
+from contextvars import ContextVar
+from time import perf_counter
+
+
+trace_log = logging.getLogger("bouncer.trace")
+
+current = ContextVar("trace", default=None)
+
+
+class Trace:
+    def __init__(self):
+        self.start = perf_counter()
+        # (name, description, seconds), in the order they ended
+        self.spans = []
+
+    def header(self):
+        """The value of a Server-Timing header, durations in milliseconds."""
+        parts = []
+        for name, description, seconds in self.spans:
+            if description:
+                name = '{};desc="{}"'.format(name, description)
+            parts.append("{};dur={:.1f}".format(name, seconds * 1000))
+        parts.append("total;dur={:.1f}".format((perf_counter() - self.start) * 1000))
+        return ", ".join(parts)
+
+    def summary(self):
+        """The same timings in one line, for the log."""
+        parts = []
+        for name, description, seconds in self.spans:
+            if description:
+                name = "{}.{}".format(name, description)
+            parts.append("{}={:.1f}ms".format(name, seconds * 1000))
+        parts.append("total={:.1f}ms".format((perf_counter() - self.start) * 1000))
+        return " ".join(parts)
+
+
+def start(rate):
+    """Trace the current request if it is sampled, with rate between 0 and 1."""
+    if rate <= 0 or (rate < 1 and random.random() >= rate):
+        return None
+    trace = Trace()
+    current.set(trace)
+    return trace
+
+
+def record(name, description, seconds):
+    """Add a stage to the trace of the current request, if it has one."""
+    trace = current.get()
+    if trace is not None:
+        trace.spans.append((name, description, seconds))
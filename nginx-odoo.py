@@ -1,31 +1,275 @@
 #!/bin/env python
 # Copyright 2020 Sunflower IT
 
-# TODO: for extra safety, dont let session_id be Odoo session id,
-# but make a new JWT token that includes the Odoo session id,
-# and translate in NGINX.
 # TODO: prevent people logging out, but setting session_id again
 # with cookie manager, then coming to Odoo login screen and
 # guessing admin password.
 
-from tornado.web import Application, RequestHandler, StaticFileHandler, MissingArgumentError
+from tornado.web import Application, HTTPError, RequestHandler, MissingArgumentError
+from tornado.httpserver import HTTPServer
 import tornado.ioloop
 import tornado.escape
+import tornado.netutil
+import tornado.process
 import asyncio
+import hashlib
+import httpx
+import os
+import signal
+import socket
+import sys
 
 import logging
 import pyotp
 
+from time import perf_counter
+
 import lib.config as config
 
-db = config.db
-OdooAuthHandler = config.OdooAuthHandler
+tenants = config.tenants
+outbox = config.outbox
 
-from lib.email import email
+from lib import logs, metrics, profiler, tracing
+from lib.fastauth import AuthRouter, purge_cached
+from lib.odooauth import OdooUnavailable
+from lib.static import PrecompressedStaticFileHandler, static_href
+from lib.throttle import FailureLog, LoginThrottle
 
-# Login page and login check
-class LoginHandler(RequestHandler):
+login_throttle = LoginThrottle(
+    config.LOGIN_IP_LIMIT,
+    config.LOGIN_USER_LIMIT,
+    config.LOGIN_WINDOW,
+    trust_loopback=config.XHEADERS,
+)
+# Logged as one summary per interval, to survive credential stuffing
+failed_logins = FailureLog("Invalid username or password")
+failed_codes = FailureLog("Invalid security code")
+throttled_logins = FailureLog("Too many failed logins, rejected")
+failed_verifications = FailureLog("Failed to verify session")
+
+# Headers of Odoo responses that are passed on when streaming them. The
+# body is passed on decompressed, like before, so not Content-Encoding.
+STREAMED_HEADERS = (
+    "Cache-Control",
+    "Content-Language",
+    "Content-Type",
+    "Expires",
+    "Last-Modified",
+)
+
+async def every(interval, func):
+    """Await func every interval seconds, for as long as the server runs."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await func()
+        except Exception:
+            logging.exception("Background task %s failed", func.__name__)
+
+
+async def boot():
+    """Checks that would delay listening, run once the server is up."""
+    for tenant in tenants:
+        try:
+            await tenant.db.cleanup()
+        except Exception:
+            logging.exception("Cleaning up the database of %s failed", tenant.name)
+        try:
+            await tenant.odoo.test()
+        except Exception:
+            logging.warning("Odoo not running at %s", tenant.odoo.params["url_jsonrpc"])
+        if not tenant.disable_email:
+            await tenant.email.test()
+
+
+async def load_revocations():
+    """Revoke the signed tokens of sessions logged out before a restart."""
+    for tenant in tenants:
+        if not tenant.signer:
+            continue
+        try:
+            removals = await tenant.db.fetch_removals()
+        except Exception as e:
+            # Would accept tokens of sessions that were logged out
+            sys.exit("Loading logouts of {} failed: {!r}".format(tenant.name, e))
+        for session, until in removals:
+            tenant.signer.revoke(session, until)
+
+
+async def check_odoo():
+    """Probe Odoo, so an open circuit closes as soon as it is back."""
+    for tenant in tenants:
+        try:
+            await tenant.odoo.test()
+        except (OdooUnavailable, httpx.HTTPStatusError):
+            pass
+
+
+async def shutdown():
+    """Write pending sessions, close pooled connections to upstream servers."""
+    for tenant in tenants:
+        await tenant.db.flush_writes()
+        await tenant.db.flush_touches()
+        await tenant.db.close()
+        await tenant.odoo.close()
+    if outbox:
+        await outbox.close()
+    for tenant in tenants:
+        await tenant.email.close()
+    logs.stop()
+
+
+def stop_workers(signum, frame):
+    """Pass SIGTERM or SIGINT on to the workers, in the parent process.
+
+    The parent keeps waiting in fork_processes, and exits once every
+    worker has run shutdown() and exited. The process group holds only
+    the parent and its workers, see the main block.
+    """
+    signal.signal(signum, signal.SIG_IGN)
+    os.killpg(os.getpgrp(), signum)
+
+
+class BaseHandler(RequestHandler):
+    # Rendered pages with their ETag, by template and arguments. The theme
+    # never changes while running, and errors are a handful of messages.
+    rendered = {}
+    # Timings of this request, when it is sampled
+    trace = None
+
+    def prepare(self):
+        # The Odoo instance this request is for
+        self.tenant = tenants.for_host(self.request.host)
+        self.trace = tracing.start(config.TRACE_RATE)
+
+    def render_string(self, template_name, **kwargs):
+        start = perf_counter()
+        try:
+            return super().render_string(template_name, **kwargs)
+        finally:
+            tracing.record(
+                "template", os.path.basename(template_name), perf_counter() - start
+            )
+
+    def flush(self, include_footers=False):
+        # Has no effect once the headers are sent, as when streaming
+        if self.trace and config.TRACE_HEADER:
+            self.set_header("Server-Timing", self.trace.header())
+        return super().flush(include_footers)
+
+    def render_cached(self, template_name, **kwargs):
+        if self.settings.get("debug"):
+            return self.render(template_name, **kwargs)
+        key = (template_name, tuple(sorted(kwargs.items())))
+        page = self.rendered.get(key)
+        if page is None:
+            html = self.render_string(template_name, **kwargs)
+            etag = '"{}"'.format(hashlib.sha1(html).hexdigest())
+            page = self.rendered[key] = (html, etag)
+        html, etag = page
+        # Check again on every visit, answered with a 304 when unchanged
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("Etag", etag)
+        if self.request.method in ("GET", "HEAD") and self.check_etag_header():
+            self.set_status(304)
+            return self.finish()
+        return self.finish(html)
+
+    async def verify_session(self):
+        session = self.get_cookie("session_id")
+        signer = self.tenant.signer
+        if signer:
+            return signer.verify(self.get_cookie(signer.cookie_name), session)
+        return await self.tenant.db.verify_session(session)
+
+    async def save_session(self, session_id, set_session_cookie=True):
+        tenant = self.tenant
+        expiry = await tenant.db.save_session(session_id, tenant.expiry_interval)
+        signer = tenant.signer
+        if set_session_cookie:
+            self.set_cookie("session_id", session_id, path="/")
+        if signer:
+            self.set_cookie(
+                signer.cookie_name,
+                signer.sign(session_id, expiry),
+                path="/",
+                httponly=True,
+            )
+
+    async def send_code(self, username, code):
+        """Mail a security code, or queue it when the outbox is enabled."""
+        if outbox:
+            return await outbox.queue(self.tenant.name, username, code)
+        return await self.tenant.email.send(username, code)
+
+    async def stream_response(self, resp):
+        """Pass a streamed Odoo response on to the client as it comes in."""
+        try:
+            for name in STREAMED_HEADERS:
+                if name in resp.headers:
+                    self.set_header(name, resp.headers[name])
+            async for chunk in resp.aiter_bytes():
+                self.write(chunk)
+                await self.flush()
+        except httpx.TransportError as e:
+            # Too late for an error page, the client sees a cut off page
+            logging.warning("Odoo response broke off: %r", e)
+        finally:
+            await resp.aclose()
+
+    def on_finish(self):
+        handler = type(self).__name__
+        metrics.REQUESTS.inc(handler, self.get_status())
+        metrics.REQUEST_DURATION.observe(self.request.request_time(), handler)
+        if self.trace and config.TRACE_LOG:
+            tracing.trace_log.info(
+                "%s %s %s %s tenant=%s",
+                self.request.method,
+                self.request.path,
+                self.get_status(),
+                self.trace.summary(),
+                self.tenant.name,
+            )
+
+
+# Prometheus metrics, only served on the metrics port
+class MetricsHandler(RequestHandler):
     def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(metrics.render())
+
+
+# Delivery status of the outbox, only served on the metrics port
+class OutboxHandler(RequestHandler):
+    async def get(self):
+        self.finish(await outbox.status())
+
+
+# Short profiles of the worker that answers, only served on the metrics port
+class ProfileHandler(RequestHandler):
+    async def get(self, kind):
+        try:
+            seconds = float(self.get_argument("seconds", 5))
+            limit = int(self.get_argument("limit", 50))
+        except ValueError:
+            raise HTTPError(400)
+        sort = self.get_argument("sort", "cumulative")
+        if not 0 < seconds <= profiler.MAX_SECONDS or sort not in profiler.SORT_KEYS:
+            raise HTTPError(400)
+        try:
+            if kind == "profile":
+                report = await profiler.profile(seconds, sort, limit)
+            else:
+                report = await profiler.allocations(seconds, limit)
+        except profiler.ProfilerBusy:
+            raise HTTPError(409)
+        self.set_header("Content-Type", "text/plain; charset=utf-8")
+        self.finish(report)
+
+
+# Login page and login check
+class LoginHandler(BaseHandler):
+    async def get(self):
         # TODO: extra protection eg. by IP or browser signature
 
         # Redirect to other service
@@ -33,50 +277,69 @@ class LoginHandler(RequestHandler):
         redirect_url = self.get_argument("redirect", None)
         if redirect_url != None:
             session_id = self.get_cookie("session_id")
-            if db.verify_session(session_id):
+            if await self.verify_session():
                 if not redirect_url.endswith("/"):
                     redirect_url += "/"
                 return self.redirect(f"{redirect_url}auth/{session_id}")
-        self.render(r"./templates/login.html", **config.theme_params)
+        self.render_cached(r"./templates/login.html", **self.tenant.theme_params)
 
     async def post(self):
         # handle username/password
         # TODO: CSRF protection
         username = self.get_body_argument("username", default=None)
         password = self.get_body_argument("password", default=None)
+        ip = self.request.remote_ip
+        if login_throttle.blocked(ip, username):
+            throttled_logins.record(username or ip)
+            self.set_status(429)
+            return self.render_cached(
+                r"./templates/login.html",
+                **self.tenant.theme_params,
+                error="Too many failed attempts, please try again later.",
+            )
         if username and password:
-            logging.info("Verifying username %s and password...", username)
-            handler = OdooAuthHandler()
-            data, session_id = await handler.check_login(username, password)
+            logging.debug("Verifying username %s and password...", username)
+            handler = self.tenant.odoo
+            try:
+                data, session_id = await handler.check_login(username, password)
+            except OdooUnavailable:
+                self.set_status(503)
+                return self.render_cached(
+                    r"./templates/login.html",
+                    **self.tenant.theme_params,
+                    error="Odoo is not available at the moment, please try again later.",
+                )
             if session_id:
-                hotp = pyotp.HOTP(config.HOTP_SECRET)
-                counter, code = db.next_hotp_id(session_id)
+                # Failures are forgotten once the security code is right too
+                hotp = pyotp.HOTP(self.tenant.hotp_secret)
+                counter, code = await self.tenant.challenges.next_hotp_id(
+                    session_id, username=username
+                )
                 key = hotp.at(counter)
-                if config.disable_email:
+                if self.tenant.disable_email:
                     # Display hotp in the log in stead of sending an email
                     logging.info(f"HOTP code: {key}")
                 else:
-                    if not await email.send(username, key):
+                    if not await self.send_code(username, key):
                         message = "Mail with security code not sent."
                         logging.error(message)
-                        return self.render(
+                        return self.render_cached(
                             r"./templates/login.html",
-                            **config.theme_params,
+                            **self.tenant.theme_params,
                             error=message,
                         )
                 return self.render(
                     r"./templates/hotp.html",
-                    **config.theme_params,
+                    **self.tenant.theme_params,
                     counter=counter,
                     code=code,
                 )
             else:
-                # TODO: brute force protection
-                #       (block for X minutes after X attempts)
+                login_throttle.failed(ip, username)
+                failed_logins.record(username)
                 message = "Invalid username or password."
-                logging.info(message)
-                return self.render(
-                    r"./templates/login.html", **config.theme_params, error=message
+                return self.render_cached(
+                    r"./templates/login.html", **self.tenant.theme_params, error=message
                 )
 
         # check HOTP
@@ -84,21 +347,41 @@ class LoginHandler(RequestHandler):
         code = self.get_body_argument("code", default=None)
         hotp_code = self.get_body_argument("hotp_code", default=None)
         if code and counter and hotp_code:
-            hotp = pyotp.HOTP(config.HOTP_SECRET)
+            hotp = pyotp.HOTP(self.tenant.hotp_secret)
             if not hotp.verify(hotp_code, int(counter)):
+                # The form does not send the username, the challenge knows it
+                username = await self.tenant.challenges.fail_code(counter, code)
+                login_throttle.failed(ip, username)
+                failed_codes.record(ip)
                 message = "Invalid security code."
-                return self.render(
-                    r"./templates/login.html", **config.theme_params, error=message
+                return self.render_cached(
+                    r"./templates/login.html", **self.tenant.theme_params, error=message
                 )
-            session_id = db.verify_code_and_expiry(counter, code)
+            (
+                session_id,
+                payload,
+                username,
+            ) = await self.tenant.challenges.verify_code_and_expiry(counter, code)
             if not session_id:
+                login_throttle.failed(ip)
+                failed_codes.record(ip)
                 message = "Invalid security code (2)."
-                return self.render(
-                    r"./templates/login.html", **config.theme_params, error=message
+                return self.render_cached(
+                    r"./templates/login.html", **self.tenant.theme_params, error=message
                 )
-            db.save_session(session_id, config.EXPIRY_INTERVAL)
+            # Guesses spread over several challenges count together
+            if login_throttle.blocked(ip, username):
+                throttled_logins.record(username)
+                self.set_status(429)
+                return self.render_cached(
+                    r"./templates/login.html",
+                    **self.tenant.theme_params,
+                    error="Too many failed attempts, please try again later.",
+                )
+            if username:
+                login_throttle.succeeded(username)
             logging.info("Setting session cookie: %s", session_id)
-            self.set_cookie("session_id", session_id, path="/")
+            await self.save_session(session_id)
             # Redirect to other service
             # needed when using the bouncer to authenticate a user
             redirect_url = self.get_argument("redirect", "/")
@@ -110,28 +393,28 @@ class LoginHandler(RequestHandler):
         return self.redirect("/")
 
 
-# Session verificaiton
-class VerifySessionHandler(RequestHandler):
-    def get(self):
-        session = self.get_cookie("session_id")
-        if db.verify_session(session):
-            self.set_status(200)
-        else:
-            logging.error(f"Failed to verify session: {session}")
-            self.set_status(401)
-        self.finish()
-
-
 # Session logout
-class LogoutHandler(RequestHandler):
-    def get(self):
+class LogoutHandler(BaseHandler):
+    async def get(self):
         session = self.get_cookie("session_id")
-        db.remove_session(session)
+        if session:
+            await self.tenant.db.remove_session(session)
+        if self.tenant.signer:
+            self.clear_cookie(self.tenant.signer.cookie_name, path="/")
+        if config.AUTH_CACHE_PURGE_URL:
+            # NGINX caches by the same cookies
+            asyncio.ensure_future(
+                purge_cached(
+                    config.AUTH_CACHE_PURGE_URL,
+                    self.request.headers.get("Cookie"),
+                    self.request.host,
+                )
+            )
         return self.redirect("/")
 
 
 # Session login
-class AuthenticateHandler(RequestHandler):
+class AuthenticateHandler(BaseHandler):
     async def post(self):
         params = tornado.escape.json_decode(self.request.body)["params"]
         database = params.get("db")
@@ -142,19 +425,31 @@ class AuthenticateHandler(RequestHandler):
         hotp_csrf = params.get("hotp_csrf")
         if not username and not password:
             return self.set_status(400)
+        ip = self.request.remote_ip
+        if login_throttle.blocked(ip, username):
+            throttled_logins.record(username or ip)
+            return self.set_status(429)
         if not (hotp_code and hotp_counter and hotp_csrf):
-            handler = OdooAuthHandler()
-            data, session_id = await handler.check_login(username, password)
+            handler = self.tenant.odoo
+            try:
+                data, session_id = await handler.check_login(username, password)
+            except OdooUnavailable:
+                return self.set_status(503)
             if not session_id:
+                login_throttle.failed(ip, username)
+                failed_logins.record(username)
                 return self.set_status(401)
-            hotp = pyotp.HOTP(config.HOTP_SECRET)
-            hotp_counter, hotp_csrf = db.next_hotp_id(session_id)
+            hotp = pyotp.HOTP(self.tenant.hotp_secret)
+            # Handed out when the code is verified, saves a second login
+            hotp_counter, hotp_csrf = await self.tenant.challenges.next_hotp_id(
+                session_id, tornado.escape.json_encode(data), username
+            )
             hotp_code = hotp.at(hotp_counter)
-            if config.disable_email:
+            if self.tenant.disable_email:
                 # Display hotp in the log in stead of sending an email
                 logging.info(f"HOTP code: {hotp_code}")
             else:
-                if not await email.send(username, hotp_code):
+                if not await self.send_code(username, hotp_code):
                     # for obfuscation, this needs to be the same as above
                     return self.set_status(401)
             return self.write(
@@ -166,39 +461,62 @@ class AuthenticateHandler(RequestHandler):
                 }
             )
         else:
-            hotp = pyotp.HOTP(config.HOTP_SECRET)
-            # TODO: memory leaks?
-            handler = OdooAuthHandler()
+            hotp = pyotp.HOTP(self.tenant.hotp_secret)
             if not hotp.verify(hotp_code, int(hotp_counter)):
+                # Counted for the user the code was sent to, not the login
+                # the client sends along
+                username = await self.tenant.challenges.fail_code(
+                    hotp_counter, hotp_csrf
+                )
+                login_throttle.failed(ip, username)
+                failed_codes.record(ip)
                 return self.set_status(401)
-            session_id = db.verify_code_and_expiry(hotp_counter, hotp_csrf)
-            # login again and return new session id
-            data, session_id = await handler.check_login(username, password)
+            (
+                session_id,
+                payload,
+                username,
+            ) = await self.tenant.challenges.verify_code_and_expiry(
+                hotp_counter, hotp_csrf
+            )
             if not session_id:
+                login_throttle.failed(ip)
+                failed_codes.record(ip)
                 # for obfuscation, this needs to be the same as above
                 return self.set_status(401)
-            # save new session id, not old one
-            db.save_session(session_id, config.EXPIRY_INTERVAL)
-            return self.write(data)
+            if login_throttle.blocked(ip, username):
+                throttled_logins.record(username)
+                return self.set_status(429)
+            if username:
+                login_throttle.succeeded(username)
+            # the session of the first step, its code is used up now
+            await self.save_session(session_id, set_session_cookie=False)
+            return self.write(tornado.escape.json_decode(payload))
 
 
 # Coupa punchout login
-class PunchoutLoginHandler(RequestHandler):
+class PunchoutLoginHandler(BaseHandler):
     async def get(self):
         token = self.get_argument("token")
         if not token:
             return self.set_status(401)
-        handler = OdooAuthHandler()
-        resp, session_id = await handler.punchout_login(token)
+        handler = self.tenant.odoo
+        try:
+            resp, session_id = await handler.punchout_login(token)
+        except OdooUnavailable:
+            return self.set_status(503)
         if not session_id:
             return self.set_status(401)
-        db.save_session(session_id, config.EXPIRY_INTERVAL)
+        try:
+            await self.save_session(session_id)
+        except Exception:
+            # Not streamed, so stream_response() does not close it
+            await resp.aclose()
+            raise
         self.set_status(200)
-        self.set_cookie("session_id", session_id, path="/")
-        self.finish(resp.text)
+        await self.stream_response(resp)
 
 # Coupa punchout signup
-class PunchoutSignupHandler(RequestHandler):
+class PunchoutSignupHandler(BaseHandler):
     async def get(self):
         try:
             token = self.get_argument("signup_token")
@@ -206,50 +524,174 @@ class PunchoutSignupHandler(RequestHandler):
             return self.set_status(401)
         if not token:
             return self.set_status(401)
-        handler = OdooAuthHandler()
+        handler = self.tenant.odoo
         # preserve session if we have it
         session_id = self.get_cookie("session_id")
-        resp, session_id = await handler.punchout_signup(token, session_id)
+        try:
+            resp, session_id = await handler.punchout_signup(token, session_id)
+        except OdooUnavailable:
+            return self.set_status(503)
         if not session_id:
             return self.set_status(401)
         self.set_status(200)
         self.set_cookie("session_id", session_id, path="/")
-        self.finish(resp.text)
+        await self.stream_response(resp)
 
     async def post(self):
         token = self.get_argument("signup_token")
         if not token:
             return self.set_status(401)
-        handler = OdooAuthHandler()
+        handler = self.tenant.odoo
         params = {k: self.get_argument(k) for k in self.request.arguments}
         # preserve session if we have it (to prevent CSRF validation problems)
         session_id = self.get_cookie("session_id")
-        resp, session_id = await handler.punchout_signup_post(token, params, session_id)
+        try:
+            resp, session_id = await handler.punchout_signup_post(
+                token, params, session_id
+            )
+        except OdooUnavailable:
+            return self.set_status(503)
         if not session_id:
             return self.set_status(401)
-        db.save_session(session_id, config.EXPIRY_INTERVAL)
+        try:
+            await self.save_session(session_id)
+        except Exception:
+            # Not streamed, so stream_response() does not close it
+            await resp.aclose()
+            raise
         self.set_status(200)
-        self.set_cookie("session_id", session_id, path="/")
-        self.finish(resp.text)
+        await self.stream_response(resp)
 
+# GET /auth never gets here, AuthRouter answers it (see lib/fastauth.py)
 app = Application(
     [
         (r"/", LoginHandler),
-        (r"/auth/?", VerifySessionHandler),
         (r"/logout/?", LogoutHandler),
-        (r"/static/(.*\.(css|jpg|png))/?", StaticFileHandler, {"path": r"./static"}),
         (r"/web/session/authenticate/?", AuthenticateHandler),
         (r"/punchouttokenlogin/?", PunchoutLoginHandler),
         (r"/punchout/signup?", PunchoutSignupHandler),
     ],
-    debug=True,
+    debug=config.DEBUG,
+    static_path=r"./static",
+    static_handler_class=PrecompressedStaticFileHandler,
+    ui_methods={"static_href": static_href},
 )
 
-if __name__ == "__main__":
-    # Check connection with email service
-    #loop = asyncio.get_event_loop()
-    #loop.run_until_complete(email.test())
+metrics_app = Application(
+    [(r"/metrics", MetricsHandler)]
+    + ([(r"/outbox", OutboxHandler)] if outbox else [])
+    + ([(r"/debug/(profile|allocations)", ProfileHandler)] if config.PROFILER else [])
+)
 
-    app.listen(config.LISTEN_PORT)
-    print(f"Listening at port {config.LISTEN_PORT}")
-    tornado.ioloop.IOLoop.current().start()
+if __name__ == "__main__":
+    router = AuthRouter(
+        app,
+        tenants,
+        failed_verifications,
+        cache_max=config.AUTH_CACHE_MAX,
+        log_rate=config.AUTH_LOG_RATE,
+    )
+    server_settings = {
+        "xheaders": config.XHEADERS,
+        "no_keep_alive": not config.KEEPALIVE,
+        "idle_connection_timeout": config.IDLE_TIMEOUT,
+    }
+    # Bound before forking, the workers share it
+    sockets = []
+    if config.LISTEN_SOCKET:
+        sockets.append(
+            tornado.netutil.bind_unix_socket(
+                config.LISTEN_SOCKET, mode=config.LISTEN_SOCKET_MODE
+            )
+        )
+    if config.WORKERS == 1:
+        if config.LISTEN_PORT:
+            sockets.extend(tornado.netutil.bind_sockets(config.LISTEN_PORT))
+        tornado.ioloop.IOLoop.current().run_sync(load_revocations)
+        server = HTTPServer(router, **server_settings)
+        server.add_sockets(sockets)
+        if config.METRICS_PORT:
+            metrics_app.listen(config.METRICS_PORT, config.METRICS_HOST)
+    else:
+        # Connections opened during startup stay with the parent
+        for tenant in tenants:
+            tenant.db.close_before_fork()
+        if outbox:
+            outbox.close_before_fork()
+        # Without this, stopping the parent would leave the workers running,
+        # or see them killed without writing their pending sessions
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, stop_workers)
+        # Started by a shell with job control or by systemd, the parent
+        # leads its own group already. Otherwise its group also holds
+        # whatever started it, which must not get the signals passed on.
+        if os.getpgrp() != os.getpid():
+            os.setpgrp()
+        if not config.LISTEN_PORT:
+            tornado.process.fork_processes(config.WORKERS)
+        elif hasattr(socket, "SO_REUSEPORT"):
+            # Every worker gets its own socket, the kernel spreads
+            # connections over them
+            tornado.process.fork_processes(config.WORKERS)
+            sockets.extend(
+                tornado.netutil.bind_sockets(config.LISTEN_PORT, reuse_port=True)
+            )
+        else:
+            sockets.extend(tornado.netutil.bind_sockets(config.LISTEN_PORT))
+            tornado.process.fork_processes(config.WORKERS)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, signal.SIG_DFL)
+        # Don't share the event loop created during startup with the parent
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        tornado.ioloop.IOLoop.current().run_sync(load_revocations)
+        server = HTTPServer(router, **server_settings)
+        server.add_sockets(sockets)
+        if config.METRICS_PORT:
+            # Every worker has its own numbers, and its own port
+            metrics_app.listen(
+                config.METRICS_PORT + tornado.process.task_id(), config.METRICS_HOST
+            )
+        for tenant in tenants:
+            tenant.db.lookup_on_miss = True
+    io_loop = tornado.ioloop.IOLoop.current()
+    # With several workers, the first one checks for all
+    if tornado.process.task_id() in (None, 0):
+        io_loop.spawn_callback(boot)
+    io_loop.spawn_callback(every, config.ODOO_HEALTH_INTERVAL, check_odoo)
+    io_loop.spawn_callback(every, config.LOGIN_WINDOW, login_throttle.prune)
+    for tenant in tenants:
+        db = tenant.db
+        # Pick up logins and logouts handled by the other workers, or by
+        # the bouncers of other hosts sharing the store
+        if db.lookup_on_miss:
+            io_loop.spawn_callback(every, config.SYNC_INTERVAL, db.sync_sessions)
+        io_loop.spawn_callback(every, config.CLEANUP_INTERVAL, db.cleanup)
+        if db.write_delay:
+            io_loop.spawn_callback(every, db.write_delay, db.flush_writes)
+        if db.sliding_lifetime:
+            io_loop.spawn_callback(every, db.touch_interval, db.flush_touches)
+        if tenant.signer:
+            io_loop.spawn_callback(every, config.CLEANUP_INTERVAL, tenant.signer.prune)
+        if tenant.challenges is not db:
+            io_loop.spawn_callback(
+                every, config.CLEANUP_INTERVAL, tenant.challenges.prune
+            )
+        io_loop.spawn_callback(every, config.SMTP_POOL_IDLE, tenant.email.expire_idle)
+    if outbox:
+        io_loop.spawn_callback(outbox.run)
+        io_loop.spawn_callback(every, config.CLEANUP_INTERVAL, outbox.cleanup)
+    for failure_log in (failed_logins, failed_codes, throttled_logins, failed_verifications):
+        io_loop.spawn_callback(every, config.FAILURE_LOG_INTERVAL, failure_log.flush)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_event_loop().add_signal_handler(signum, io_loop.stop)
+    if config.LISTEN_PORT:
+        print(f"Listening at port {config.LISTEN_PORT}")
+    if config.LISTEN_SOCKET:
+        print(f"Listening at {config.LISTEN_SOCKET}")
+    io_loop.start()
+    # The same signal may come from the parent as well, it must not cut
+    # the shutdown short
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_event_loop().remove_signal_handler(signum)
+        signal.signal(signum, signal.SIG_IGN)
+    io_loop.run_sync(shutdown)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The bouncer is run from its checkout, not installed: import lib and
+# bench from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
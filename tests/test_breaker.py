@@ -0,0 +1,95 @@
+import pytest
+
+from lib import breaker
+from lib.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(1000.0)
+    monkeypatch.setattr(breaker, "time", clock)
+    return clock
+
+
+def opened(clock):
+    circuit = CircuitBreaker("Odoo", rate=0.5, calls=4, reset_timeout=30)
+    for _ in range(4):
+        circuit.failed()
+    assert circuit.state == OPEN
+    return circuit
+
+
+def test_opens_at_rate(clock):
+    circuit = CircuitBreaker("Odoo", rate=0.5, calls=4, reset_timeout=30)
+    circuit.succeeded()
+    circuit.failed()
+    circuit.succeeded()
+    assert circuit.state == CLOSED
+    # Half of the last 4 calls failed
+    circuit.failed()
+    assert circuit.state == OPEN
+    assert not circuit.allow()
+
+
+def test_waits_for_enough_calls(clock):
+    circuit = CircuitBreaker("Odoo", rate=0.5, calls=4, reset_timeout=30)
+    for _ in range(3):
+        circuit.failed()
+    assert circuit.state == CLOSED
+    assert circuit.allow()
+
+
+def test_old_failures_slide_out(clock):
+    circuit = CircuitBreaker("Odoo", rate=0.5, calls=4, reset_timeout=30)
+    circuit.failed()
+    for _ in range(4):
+        circuit.succeeded()
+    circuit.failed()
+    assert circuit.state == CLOSED
+
+
+def test_one_probe_after_timeout(clock):
+    circuit = opened(clock)
+    clock.now += 29
+    assert not circuit.allow()
+    clock.now += 1
+    assert circuit.allow()
+    assert circuit.state == HALF_OPEN
+    # Only one call at a time probes
+    assert not circuit.allow()
+
+
+def test_probe_succeeds(clock):
+    circuit = opened(clock)
+    clock.now += 30
+    assert circuit.allow()
+    circuit.succeeded()
+    assert circuit.state == CLOSED
+    # Failures before opening are forgotten, the window fills again
+    # from the probe on
+    circuit.failed()
+    circuit.failed()
+    assert circuit.state == CLOSED
+    circuit.failed()
+    assert circuit.state == OPEN
+
+
+def test_probe_fails(clock):
+    circuit = opened(clock)
+    clock.now += 30
+    assert circuit.allow()
+    circuit.failed()
+    assert circuit.state == OPEN
+    # The timeout starts again
+    clock.now += 29
+    assert not circuit.allow()
+    clock.now += 1
+    assert circuit.allow()
@@ -0,0 +1,104 @@
+"""Converting a database of the first version of the bouncer."""
+
+import asyncio
+import sqlite3
+
+from time import time
+
+from lib.challenges import MAX_CODE_FAILURES
+from lib.db import DB, SCHEMA_VERSION
+
+
+def baseline_database(path):
+    """A database as the first version left it, with times as text."""
+
+    con = sqlite3.connect(path)
+    with con:
+        con.execute(
+            """
+            create table hotp_codes (
+                id integer primary key autoincrement,
+                expiry datetime,
+                code character(16),
+                session_id character(20)
+            )
+        """
+        )
+        con.execute(
+            """
+            create table odoo_sessions (
+                id integer primary key autoincrement,
+                session_id character(20),
+                expiry datetime
+            )
+        """
+        )
+        con.execute(
+            "create unique index idx_session_id on odoo_sessions (session_id)"
+        )
+        con.executemany(
+            """
+            insert into odoo_sessions (session_id, expiry)
+            select ?, datetime(datetime(), ?)
+        """,
+            [("valid", "+1 hours"), ("expired", "-1 hours")],
+        )
+        con.executemany(
+            """
+            insert into hotp_codes (expiry, code, session_id)
+            select datetime(datetime(), '+15 minutes'), ?, ?
+        """,
+            [("CODE1", "valid"), ("CODE2", "valid")],
+        )
+    con.close()
+
+
+def test_migrate_baseline(tmp_path):
+    path = str(tmp_path / "database.db")
+    baseline_database(path)
+    db = DB(path)
+    try:
+        con = db.connect()
+        assert con.execute("pragma user_version").fetchone()[0] == SCHEMA_VERSION
+        # Times are seconds since the epoch, in UTC like the text was
+        for table in ("odoo_sessions", "hotp_codes"):
+            types = con.execute(
+                "select distinct typeof(expiry) from {}".format(table)
+            ).fetchall()
+            assert types == [("integer",)]
+        assert abs(db.session_cache["valid"] - (time() + 3600)) < 5
+        assert "expired" not in db.session_cache
+        assert db.check_session("valid")
+        assert not db.check_session("expired")
+
+        # Codes sent before the upgrade still work, without payload or user
+        assert asyncio.run(db.verify_code_and_expiry(1, "CODE1")) == (
+            "valid",
+            None,
+            None,
+        )
+        # and count wrong guesses
+        for _ in range(MAX_CODE_FAILURES):
+            assert asyncio.run(db.fail_code(2, "CODE2")) is None
+        assert asyncio.run(db.verify_code_and_expiry(2, "CODE2"))[0] is False
+    finally:
+        db.close_before_fork()
+
+
+def test_migrate_twice(tmp_path):
+    path = str(tmp_path / "database.db")
+    baseline_database(path)
+    DB(path).close_before_fork()
+    con = sqlite3.connect(path)
+    before = con.execute("select session_id, expiry from odoo_sessions").fetchall()
+    con.close()
+
+    db = DB(path)
+    try:
+        after = db.connect().execute(
+            "select session_id, expiry from odoo_sessions"
+        ).fetchall()
+        assert after == before
+        assert db.check_session("valid")
+    finally:
+        db.close_before_fork()
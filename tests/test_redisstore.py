@@ -0,0 +1,149 @@
+"""RedisStore against the stand-in Redis server of bench/stubs.py."""
+
+import asyncio
+
+from time import time
+
+from bench.stubs import RedisStub
+from lib.challenges import MAX_CODE_FAILURES
+from lib.redisstore import RedisStore
+
+
+def run(scenario):
+    """Run scenario(open_store) against a fresh RedisStub."""
+
+    async def main():
+        server = await RedisStub().start("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        stores = []
+
+        def open_store():
+            store = RedisStore("redis://127.0.0.1:{}/0".format(port), "test:")
+            stores.append(store)
+            return store
+
+        try:
+            await scenario(open_store)
+        finally:
+            for store in stores:
+                await store.close()
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_session_saved_and_loaded():
+    async def scenario(open_store):
+        store, other = open_store(), open_store()
+        expiry = await store.save_session("s1", "+1 hours")
+        assert expiry > time() + 3500
+        assert await other.fetch_session("s1") == expiry
+        # Not cached yet, looked up
+        assert other.check_session("s1") is None
+        assert await other.verify_session("s1")
+        assert other.session_cache["s1"] == expiry
+        assert not await other.verify_session("unknown")
+
+    run(scenario)
+
+
+def test_session_removed():
+    async def scenario(open_store):
+        store, other = open_store(), open_store()
+        await store.save_session("s1", "+1 hours")
+        await store.remove_session("s1")
+        assert not store.check_session("s1")
+        assert await other.fetch_session("s1") is None
+        assert not await other.verify_session("s1")
+
+    run(scenario)
+
+
+def test_changes_reach_other_store():
+    async def scenario(open_store):
+        store, other = open_store(), open_store()
+        removed = []
+        other.removal_listeners.append(removed.append)
+        # The first call only finds where the stream ends
+        await store.save_session("before", "+1 hours")
+        await other.sync_sessions()
+        assert "before" not in other.session_cache
+
+        expiry = await store.save_session("s1", "+1 hours")
+        await other.sync_sessions()
+        assert other.session_cache["s1"] == expiry
+
+        await store.remove_session("s1")
+        await other.sync_sessions()
+        assert "s1" not in other.session_cache
+        assert removed == ["s1"]
+
+    run(scenario)
+
+
+def test_removals_remembered():
+    async def scenario(open_store):
+        store = open_store()
+        store.keep_removals = 3600
+        await store.save_session("s1", "+1 hours")
+        await store.remove_session("s1")
+        ((session, until),) = await open_store().fetch_removals()
+        assert session == "s1"
+        assert until > time() + 3500
+
+    run(scenario)
+
+
+def test_code_verified_once():
+    async def scenario(open_store):
+        store, other = open_store(), open_store()
+        counter, code = await store.next_hotp_id("s1", "payload", "alice")
+        assert await other.verify_code_and_expiry(counter, "WRONG") == (
+            False,
+            None,
+            None,
+        )
+        assert await other.verify_code_and_expiry(counter, code) == (
+            "s1",
+            "payload",
+            "alice",
+        )
+        assert await store.verify_code_and_expiry(counter, code) == (
+            False,
+            None,
+            None,
+        )
+        assert await store.verify_code_and_expiry("not a number", code) == (
+            False,
+            None,
+            None,
+        )
+
+    run(scenario)
+
+
+def test_code_dropped_after_failures():
+    async def scenario(open_store):
+        store, other = open_store(), open_store()
+        counter, code = await store.next_hotp_id("s1", None, "alice")
+        # Without the form code of the challenge, guesses do not count
+        for _ in range(MAX_CODE_FAILURES):
+            assert await other.fail_code(counter, "WRONG") is None
+        # Counted by both stores together
+        for i in range(MAX_CODE_FAILURES - 1):
+            failing = (store, other)[i % 2]
+            assert await failing.fail_code(counter, code) == "alice"
+        assert (await store.verify_code_and_expiry(counter, code))[0] == "s1"
+
+        counter, code = await store.next_hotp_id("s2", None, "bob")
+        for _ in range(MAX_CODE_FAILURES):
+            assert await store.fail_code(counter, code) == "bob"
+        assert await other.verify_code_and_expiry(counter, code) == (
+            False,
+            None,
+            None,
+        )
+        assert await other.fail_code(counter, code) is None
+
+    run(scenario)
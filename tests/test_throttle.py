@@ -0,0 +1,108 @@
+import pytest
+
+from lib import throttle
+from lib.throttle import LoginThrottle, SlidingWindow
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(6000.0)
+    monkeypatch.setattr(throttle, "time", clock)
+    return clock
+
+
+def test_blocked_at_limit(clock):
+    window = SlidingWindow(3, 60)
+    for _ in range(2):
+        window.add("key")
+    assert window.count("key") == 2
+    assert not window.blocked("key")
+    window.add("key")
+    assert window.blocked("key")
+    assert not window.blocked("other")
+
+
+def test_previous_window_fades(clock):
+    window = SlidingWindow(3, 60)
+    for _ in range(3):
+        window.add("key")
+    # All of the previous window still falls in the sliding one
+    clock.now += 60
+    assert window.count("key") == pytest.approx(3)
+    assert window.blocked("key")
+    # Half of it
+    clock.now += 30
+    assert window.count("key") == pytest.approx(1.5)
+    assert not window.blocked("key")
+    window.add("key")
+    assert window.count("key") == pytest.approx(2.5)
+    # A window later, only the event in the last one is left, fading
+    clock.now += 30
+    assert window.count("key") == pytest.approx(1)
+    clock.now += 60
+    assert window.count("key") == 0
+
+
+def test_no_limit(clock):
+    window = SlidingWindow(0, 60)
+    for _ in range(100):
+        window.add("key")
+    assert not window.blocked("key")
+
+
+def test_reset(clock):
+    window = SlidingWindow(1, 60)
+    window.add("key")
+    window.reset("key")
+    assert window.count("key") == 0
+    window.reset("unknown")
+
+
+def test_prune(clock):
+    window = SlidingWindow(3, 60)
+    window.add("old")
+    clock.now += 60
+    window.add("recent")
+    window.prune()
+    assert set(window.counters) == {"old", "recent"}
+    clock.now += 60
+    window.prune()
+    assert set(window.counters) == {"recent"}
+
+
+def test_throttle_by_ip_and_user(clock):
+    logins = LoginThrottle(ip_limit=2, user_limit=2, window=60)
+    logins.failed("192.0.2.1", "Alice")
+    logins.failed("192.0.2.1")
+    assert logins.blocked("192.0.2.1")
+    assert not logins.blocked("192.0.2.2", "bob")
+    # Usernames are counted without case
+    logins.failed("192.0.2.3", "ALICE")
+    assert logins.blocked("192.0.2.2", "alice")
+    logins.succeeded("alice")
+    assert not logins.blocked("192.0.2.2", "Alice")
+    # A successful login does not clear the count of its IP
+    assert logins.blocked("192.0.2.1", "Alice")
+
+
+@pytest.mark.parametrize("ip", ["127.0.0.1", "::1", "0.0.0.0", "not an ip"])
+def test_proxy_addresses_not_limited(clock, ip):
+    logins = LoginThrottle(ip_limit=1, user_limit=1, window=60)
+    logins.failed(ip)
+    assert not logins.blocked(ip)
+    logins.failed(ip, "alice")
+    assert logins.blocked(ip, "alice")
+
+
+def test_trusted_loopback_limited(clock):
+    logins = LoginThrottle(ip_limit=1, user_limit=1, window=60, trust_loopback=True)
+    logins.failed("127.0.0.1")
+    assert logins.blocked("127.0.0.1")
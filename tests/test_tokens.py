@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+from lib.tokens import TokenSigner
+
+
+def signer(tenant="default", secret="secret"):
+    return TokenSigner(secret, 3600, tenant)
+
+
+def test_valid_token():
+    expiry = int(time.time()) + 600
+    token = signer().sign("s1", expiry)
+    assert signer().decode(token) == ("s1", expiry)
+    assert signer().valid_until(token, "s1") == expiry
+    assert signer().verify(token, "s1")
+    # Plain cookie characters only
+    assert "=" not in token and ";" not in token
+
+
+def test_session_with_separator():
+    expiry = int(time.time()) + 600
+    token = signer().sign("a|b", expiry)
+    assert signer().valid_until(token, "a|b") == expiry
+
+
+def test_other_session():
+    token = signer().sign("s1", time.time() + 600)
+    assert signer().valid_until(token, "s2") is None
+    assert signer().valid_until(token, None) is None
+
+
+def test_expired():
+    token = signer().sign("s1", time.time() - 1)
+    assert signer().decode(token) is not None
+    assert signer().valid_until(token, "s1") is None
+
+
+def test_tampered():
+    token = signer().sign("s1", time.time() + 600)
+    encoded, mac = token.split(".")
+    forged = signer().sign("s2", time.time() + 600).split(".")[0]
+    assert signer().decode(forged + "." + mac) is None
+    assert signer().decode(encoded) is None
+    assert signer().decode(encoded + "." + mac[:-1]) is None
+    assert signer(secret="other").decode(token) is None
+
+
+def test_garbage():
+    for token in (None, "", ".", "x.y", "%%%.abc", "é.é"):
+        assert signer().decode(token) is None
+
+
+def test_other_tenant():
+    token = signer("alpha").sign("s1", time.time() + 600)
+    # Even when both tenants share the secret
+    assert signer("beta").decode(token) is None
+    assert signer("alpha").decode(token) is not None
+
+
+def test_revoked():
+    tokens = signer()
+    token = tokens.sign("s1", time.time() + 600)
+    tokens.revoke("s1")
+    assert tokens.valid_until(token, "s1") is None
+    # Remembered for as long as a token can be valid
+    assert tokens.revoked["s1"] >= time.time() + 3590
+
+
+def test_prune():
+    tokens = signer()
+    tokens.revoke("old", time.time() - 1)
+    tokens.revoke("recent", time.time() + 60)
+    asyncio.run(tokens.prune())
+    assert set(tokens.revoked) == {"recent"}